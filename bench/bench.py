@@ -0,0 +1,327 @@
+"""Офлайн-бенчмарк циклу бота: записані сторінки ЛОЕ + локальна заміна Telegram Bot API.
+
+Запуск:  python bench/bench.py [--repeat N] [--out bench_output.txt]
+         python bench/bench.py --selftest   (самоперевірки інваріантів; код виходу 1 при збої)
+
+Один локальний HTTP-сервер віддає записані відповіді API графіків (bench/pages/*.json,
+плейсхолдери {today}/{tomorrow} підставляються при віддачі) та імітує методи Telegram
+(sendMessage, sendPhoto, editMessage*, deleteMessage(s), getUpdates) разом з відповідями 400
+"message is not modified" та 429 retry_after. Для кожного сценарію check_and_update() проганяється
+як перша публікація, як холостий цикл, як примусова повторна перевірка, під 429 і як цикли з командами
+користувача; extract_group_info() (з old_data і без) та розбір блоку LoeProvider.parse_block()
+міряються окремо. Результат - JSON з латентністю етапів, кількістю запитів/байтів по ендпоінтах
+та піком пам'яті.
+"""
+import os, sys, json, time, random, argparse, tempfile, threading, tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+PAGES_DIR = os.path.join(HERE, "pages")
+PNG = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082")
+
+# --- ЛОКАЛЬНИЙ СЕРВЕР (САЙТ + TELEGRAM) ---
+class FakeWorld:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Чистий світ для кожного сценарію: без чужих оновлень у черзі getUpdates."""
+        self.page = b"{}"
+        self.updates = []
+        self.next_update = 1
+        self.next_mid = 1000
+        self.messages = {} # message_id -> поточний текст/підпис: однакова правка дає 400, як у Telegram
+        self.throttle_next = 0 # скільки наступних викликів Telegram отримають 429
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.requests = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def set_page(self, name):
+        today = datetime.now()
+        with open(os.path.join(PAGES_DIR, f"{name}.json"), encoding="utf-8") as f:
+            text = f.read()
+        text = text.replace("{today}", today.strftime("%d.%m.%Y")).replace("{tomorrow}", (today + timedelta(days=1)).strftime("%d.%m.%Y"))
+        self.page = text.encode("utf-8")
+
+    def push_message(self, chat_id, text):
+        with self.lock:
+            self.updates.append({"update_id": self.next_update, "message": {
+                "message_id": 10 ** 6 + self.next_update, "chat": {"id": int(chat_id)}, "text": text}})
+            self.next_update += 1
+
+    def telegram(self, method, params):
+        with self.lock:
+            if method == "getUpdates":
+                offset = int(params.get("offset", 0))
+                return {"ok": True, "result": [u for u in self.updates if u["update_id"] >= offset]}
+            if self.throttle_next:
+                self.throttle_next -= 1
+                return {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}}
+            if method == "deleteMessage": self.messages.pop(int(params.get("message_id", 0)), None)
+            if method == "deleteMessages":
+                for mid in json.loads(params.get("message_ids", "[]")): self.messages.pop(int(mid), None)
+            if method in ("deleteMessage", "deleteMessages"): return {"ok": True, "result": True}
+            content = params.get("text") or params.get("caption") or params.get("media")
+            if method.startswith("editMessage"):
+                mid = int(params.get("message_id", 0))
+                if mid not in self.messages: return {"ok": False, "error_code": 400, "description": "Bad Request: message to edit not found"}
+                if self.messages[mid] == content and "attach://" not in content: # нове вивантаження - завжди зміна
+                    return {"ok": False, "error_code": 400, "description": "Bad Request: message is not modified"}
+                self.messages[mid] = content
+                return {"ok": True, "result": True}
+            self.next_mid += 1
+            self.messages[self.next_mid] = content
+            result = {"message_id": self.next_mid}
+            if method == "sendPhoto": result["photo"] = [{"file_id": f"FILE{self.next_mid}"}]
+            return {"ok": True, "result": result}
+
+WORLD = FakeWorld()
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args): pass
+
+    def reply(self, body, ctype="application/json", status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        WORLD.bytes[self.endpoint] += len(body)
+
+    def handle_any(self, body=b""):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        self.endpoint = parts[-1] if parts[0].startswith("bot") else parts[0]
+        WORLD.requests[self.endpoint] += 1
+        WORLD.bytes[self.endpoint] += len(body)
+        if parts[0].startswith("bot"):
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+            resp = WORLD.telegram(parts[-1], params)
+            return self.reply(json.dumps(resp).encode("utf-8"), status=resp.get("error_code", 200))
+        if parts[0] == "media": return self.reply(PNG, "image/png")
+        return self.reply(WORLD.page)
+
+    def do_GET(self): self.handle_any()
+
+    def do_POST(self):
+        self.handle_any(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+# --- ЗАМІРИ ЕТАПІВ ---
+STAGES = ["load_memory", "collect_user_commands", "LoeProvider.fetch", "LoeProvider.analyze", "dispatch_updates", "save_memory"]
+TIMINGS = defaultdict(list)
+
+def instrument(script, timings=TIMINGS):
+    for name in STAGES:
+        owner, attr = script, name
+        if "." in name: # метод класу, напр. "LoeProvider.analyze"
+            cls, attr = name.split(".")
+            owner = getattr(script, cls)
+        original = getattr(owner, attr)
+        def timed(*args, _original=original, _name=name, **kwargs):
+            t0 = time.perf_counter()
+            try: return _original(*args, **kwargs)
+            finally: timings[_name].append((time.perf_counter() - t0) * 1000)
+        setattr(owner, attr, timed)
+
+def run_step(script, label, command=None, full=False, throttle=0):
+    """Один виклик check_and_update() з вимірами. command - текст від користувача перед циклом;
+    full - розібрати сторінку попри незмінний відбиток; throttle - скільки викликів Telegram отримають 429."""
+    if command: WORLD.push_message(script.CHAT_ID, command)
+    WORLD.reset_counters()
+    WORLD.throttle_next = throttle
+    TIMINGS.clear()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    branch = script.check_and_update(full=full)
+    total = (time.perf_counter() - t0) * 1000
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "step": label, "branch": branch, "total_ms": round(total, 3),
+        "stages_ms": {k: round(sum(v), 3) for k, v in TIMINGS.items()},
+        "requests": dict(WORLD.requests), "bytes": dict(WORLD.bytes),
+        "requests_total": sum(WORLD.requests.values()), "peak_kb": round(peak / 1024, 1),
+        "cycle_metrics": script.metrics.last_cycle,
+    }
+
+def bench_parser(script, page_name, repeat):
+    WORLD.set_page(page_name)
+    loe = script.LoeProvider()
+    snap = loe.fetch_http(script.FetchSession())
+    if not snap: return None
+    blocks = snap["text"].split(loe.BLOCK_HEAD)[1:]
+    groups = [f"{i}.{j}" for i in range(1, 7) for j in (1, 2)]
+    # old_data - дані тієї ж групи з попереднього циклу: рендер з порівнянням (підкреслення змін)
+    old = {(k, g): script.extract_group_info(b, g)[1] for k, b in enumerate(blocks) for g in groups}
+    def per_call(with_old):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            for k, b in enumerate(blocks):
+                for g in groups: script.extract_group_info(b, g, old[k, g] if with_old else None)
+        return round((time.perf_counter() - t0) * 1e6 / max(1, repeat * len(blocks) * len(groups)), 3)
+    us_per_call, us_per_call_with_old = per_call(False), per_call(True)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for b in blocks: loe.parse_block(b)
+    per_block = (time.perf_counter() - t0) * 1e6 / max(1, repeat * len(blocks))
+    return {"blocks": len(blocks), "calls": repeat * len(blocks) * len(groups), "us_per_call": us_per_call,
+            "us_per_call_with_old": us_per_call_with_old, "us_per_block_all_groups": round(per_block, 3)}
+
+# --- САМОПЕРЕВІРКИ (--selftest) ---
+# Кожна перевірка - функція(script), що кидає AssertionError з описом порушення.
+SELFTESTS = []
+
+def selftest(fn):
+    SELFTESTS.append(fn)
+    return fn
+
+def expect(cond, what):
+    if not cond: raise AssertionError(what)
+
+@selftest
+def check_image_cache_threads(script):
+    """8 потоків шлють понад IMG_INDEX_MAX різних рендерів при тісному ліміті диска: жодного винятку
+    чи відмови, а індекс після розсилки цілісний (кожен URL веде на blob з часом використання)."""
+    cache = script.ImageCache(max_bytes=64 * 1024)
+    refs = [f"render:1.1:01.01.2030:{m}-{m + 30}" for m in range(0, (script.IMG_INDEX_MAX + 100) * 4, 4)]
+    errors, lock = [], threading.Lock()
+    def worker(seed):
+        rnd = random.Random(seed)
+        for _ in range(150):
+            try: ok = script.tg.ok(cache.send_photo(1001, rnd.choice(refs), "selftest"))
+            except Exception as e: ok = repr(e)
+            if ok is not True:
+                with lock: errors.append(ok)
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    urls, blobs = cache.index["urls"], cache.index["blobs"]
+    expect(not errors, f"{len(errors)} збоїв send_photo, перший: {errors[:1]}")
+    expect(all(m.get("sha") in blobs for m in urls.values()), "URL посилається на витіснений blob")
+    expect(all("used" in b for b in blobs.values()), "blob без часу використання")
+    expect(len(blobs) <= script.IMG_INDEX_MAX, f"індекс не витіснено: {len(blobs)} записів")
+    expect(not cache.busy, f"лічильник зайнятих URL не обнулився: {dict(cache.busy)}")
+
+@selftest
+def check_plan_changes(script):
+    """Точкові правки замість перебудови: зсув доби, нова дата в кінці, зміна годин; None там, де порядок
+    повідомлень правками не зберегти."""
+    day = lambda periods, light=False, site_time="10:00": {"periods": periods, "is_full_light": light, "site_time": site_time}
+    a, b, c = day([["08:00", "10:00"]]), day([["12:00", "14:00"]]), day([], light=True)
+    sub = lambda dates, mids: {"msg_ids": mids, "last_dates": dates, "hours_by_date": {"d1": a, "d2": b, "d3": c}}
+    cases = [
+        ("без змін", sub(["d1", "d2"], [1, 2]), ["d1", "d2"], {"d1": a, "d2": b}, 2, []),
+        ("лише час 'станом на'", sub(["d1", "d2"], [1, 2]), ["d1", "d2"], {"d1": a, "d2": day(b["periods"], site_time="11:30")}, 2, []),
+        ("змінились години", sub(["d1", "d2"], [1, 2]), ["d1", "d2"], {"d1": a, "d2": c}, 2, [("edit", 1, 2)]),
+        ("нова дата в кінці", sub(["d1"], [1]), ["d1", "d2"], {"d1": a, "d2": b}, 2, [("append", 1)]),
+        ("зсув доби", sub(["d1", "d2"], [1, 2]), ["d2", "d3"], {"d2": b, "d3": c}, 2, [("drop", 1), ("append", 1)]),
+        ("зсув доби зі зміною", sub(["d1", "d2"], [1, 2]), ["d2"], {"d2": c}, 1, [("drop", 1), ("edit", 0, 2)]),
+        ("картинок менше, ніж дат", sub(["d1"], [1]), ["d1", "d2"], {"d1": a, "d2": b}, 1, []),
+        ("переставлені дати", sub(["d1", "d2"], [1, 2]), ["d2", "d1"], {"d1": a, "d2": b}, 2, None),
+        ("нова дата перед старою", sub(["d2"], [2]), ["d1", "d2"], {"d1": a, "d2": b}, 2, None),
+        ("msg_ids не збігаються з датами", sub(["d1", "d2"], [1]), ["d1", "d2"], {"d1": a, "d2": b}, 2, None),
+        ("msg_ids старого формату", sub(["d1"], 1), ["d1"], {"d1": a}, 1, None),
+    ]
+    for name, s, dates, new_map, n_imgs, want in cases:
+        got = script.plan_changes(s, dates, new_map, [f"img{k}" for k in range(n_imgs)])
+        expect(got == want, f"{name}: очікував {want}, отримав {got}")
+
+@selftest
+def check_timeline_midnight(script):
+    """Відключення через північ: без "off" о 00:00 і "on" о 24:00; сусідня доба перераховується при зміні
+    чи відкликанні графіка."""
+    tl = script.Timeline(leads=(5,))
+    d1, d2 = ((datetime.now() + timedelta(days=k)).strftime("%d.%m.%Y") for k in (1, 2))
+    events = lambda date_str: sorted((k[2], k[3]) for k in tl.slots[("1.1", date_str)])
+    tl.update("1.1", d1, script.span_mask(1320, 1440), time.time())
+    expect(events(d1) == [("off", 1320)], f"без наступної доби 24:00 невідоме: {events(d1)}")
+    tl.update("1.1", d2, script.span_mask(0, 120), time.time())
+    expect(events(d1) == [("off", 1320)] and events(d2) == [("on", 120)], f"через північ: {events(d1)} / {events(d2)}")
+    tl.update("1.1", d2, script.span_mask(60, 120), time.time())
+    expect(events(d1) == [("off", 1320), ("on", 1440)], f"наступна доба почалась зі світлом: {events(d1)}")
+    expect(events(d2) == [("off", 60), ("on", 120)], f"{events(d2)}")
+    tl.update("1.1", d2, script.span_mask(0, 120), time.time())
+    tl.cancel(("1.1", d2))
+    expect(events(d1) == [("off", 1320)], f"відкликана наступна доба: {events(d1)}")
+    expect(sorted(k[1:4] for k in tl.live) == [(d1, "off", 1320)], f"живі події: {sorted(tl.live)}")
+
+def run_selftests(script):
+    failed = 0
+    for fn in SELFTESTS:
+        with tempfile.TemporaryDirectory() as tmp, redirect_stdout(sys.stderr):
+            os.chdir(tmp)
+            WORLD.reset()
+            try:
+                fn(script)
+                status = "ok"
+            except AssertionError as e:
+                failed += 1
+                status = f"FAIL: {e}"
+            finally: os.chdir(ROOT)
+        print(f"{'✅' if status == 'ok' else '❌'} {fn.__name__}: {status}")
+    return failed
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--repeat", type=int, default=200, help="повторів для мікробенчмарку парсера")
+    ap.add_argument("--out", help="файл для JSON-звіту (за замовчуванням - stdout)")
+    ap.add_argument("--pages", default="full_light,many_outages,two_dates,ukrenergo_only,broken")
+    ap.add_argument("--selftest", action="store_true", help="лише самоперевірки, без бенчмарку")
+    args = ap.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.update({
+        "TELEGRAM_API": base, "TELEGRAM_TOKEN": "/botBENCH", "TELEGRAM_CHAT_ID": "1001",
+        "LOE_API_URL": f"{base}/api/menus?page=1&type=photo-grafic", "FETCH_ENGINES": "http",
+    })
+    os.environ.setdefault("TG_RATE", "1000") # міряємо код, а не ліміт Telegram
+    sys.path.insert(0, ROOT)
+    import script
+    if args.selftest:
+        failed = run_selftests(script)
+        server.shutdown()
+        sys.exit(1 if failed else 0)
+    instrument(script)
+
+    report = {"generated": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0], "scenarios": []}
+    for name in args.pages.split(","):
+        with tempfile.TemporaryDirectory() as tmp, redirect_stdout(sys.stderr): # журнал бота - у stderr
+            os.chdir(tmp)
+            script._saved_text = None
+            script._last_pages.clear()
+            script.image_cache = script.ImageCache()
+            WORLD.reset()
+            WORLD.set_page(name)
+            steps = [
+                run_step(script, "first_publish"),
+                run_step(script, "idle"),
+                run_step(script, "forced_recheck", full=True), # та сама сторінка: жодної правки без змін
+                run_step(script, "user_photo_mode", command="/1"),
+                run_step(script, "telegram_429", command="/2", throttle=1),
+                run_step(script, "user_clear", command="hello"),
+                run_step(script, "user_group_change", command="/3.2"),
+            ]
+            report["scenarios"].append({"page": name, "steps": steps, "parser": bench_parser(script, name, args.repeat)})
+            os.chdir(ROOT)
+    server.shutdown()
+
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: f.write(text)
+    else: print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,403 +1,1593 @@
-import os, io, re, requests, time, json
-from datetime import datetime
+import os, re, sys, shutil, signal, threading, hashlib, heapq, queue, struct, zlib, requests, time, json
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from requests.adapters import HTTPAdapter
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timedelta
 from urllib.parse import urljoin
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
+from html.parser import HTMLParser
 
 
 # --- КОНФІГУРАЦІЯ ---
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 URL_SITE = "https://poweron.loe.lviv.ua"
+URL_API = os.getenv("LOE_API_URL", "https://api.loe.lviv.ua/api/menus?page=1&type=photo-grafic")
 MEMORY_FILE = "last_memory.txt"
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "7"))            # днів, для яких зберігаємо всі версії графіка
+HISTORY_KEEP_DAYS = int(os.getenv("HISTORY_KEEP_DAYS", "31")) # днів, після яких дата зникає з історії
+HISTORY_LOG = os.getenv("HISTORY_LOG", "history_log.jsonl")  # журнал усіх версій (лише дописування), "" - вимкнено
+STATS_DAYS = 62                                               # днів, для яких тримаємо добові підсумки
+# Провайдери (сайти обленерго) опитуються паралельно, кожен - зі своїм таймаутом
+PROVIDERS = [p.strip() for p in os.getenv("PROVIDERS", "loe").split(",") if p.strip()]
+PROVIDER_TIMEOUT = int(os.getenv("PROVIDER_TIMEOUT", "90"))   # секунд на провайдера за цикл
+FETCH_ENGINES = [e.strip() for e in os.getenv("FETCH_ENGINES", "http,selenium").split(",") if e.strip()]
+HTTP_TIMEOUT = 15
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))      # паралельних розсилок підписникам
+# Telegram: пул з'єднань, ліміт частоти та повтори
+TG_API = os.getenv("TELEGRAM_API", "https://api.telegram.org")
+TG_RATE = float(os.getenv("TG_RATE", "25"))             # запитів на секунду (ліміт Telegram ~30)
+TG_TIMEOUT = 20
+TG_RETRIES = 3
+TG_LONG_POLL = 50                                       # секунд long-polling getUpdates у режимі демона
+# Кеш картинок для режиму Фото: байти на диску, file_id - у пам'яті бота
+IMG_CACHE_DIR = os.getenv("IMG_CACHE_DIR", "img_cache")
+IMG_CACHE_MAX = int(os.getenv("IMG_CACHE_MAX", str(20 * 1024 * 1024)))  # байт на диску
+IMG_INDEX_MAX = 200                                                     # записів в індексі
+IMAGE_SOURCE = os.getenv("IMAGE_SOURCE", "local")  # local - власний графік групи, site - PNG з сайту ЛОЕ
+# Режим демона: перевикористання сесії та адаптивний інтервал опитування
+RECYCLE_AFTER = int(os.getenv("RECYCLE_AFTER", "50"))   # перезапуск браузера/сесії кожні N циклів
+POLL_FAST = int(os.getenv("POLL_FAST", "30"))           # секунд, одразу після змін та в години публікацій
+POLL_BASE = int(os.getenv("POLL_BASE", "140"))          # секунд, звичайний інтервал
+POLL_MAX = int(os.getenv("POLL_MAX", "900"))            # секунд, стеля відкату при тиші
+HOT_WINDOW = int(os.getenv("HOT_WINDOW", "1800"))       # секунд частого опитування після зміни
+PUBLISH_HOURS = os.getenv("PUBLISH_HOURS", "7-9,17-23") # години, коли ЛОЕ зазвичай публікує графіки
+# Нагадування перед переходами світло/темрява (лише в режимі демона)
+REMINDER_LEADS = sorted({int(x) for x in os.getenv("REMINDERS", "30,10").split(",") if x.strip()}, reverse=True) # хвилин до події
+REMINDER_MAX_LATE = 300                                 # секунд: пізніші нагадування вже не шлемо
+# Спостережуваність: JSON-рядок з таймінгами після кожного циклу, /metrics у режимі демона
+METRICS_LOG = os.getenv("METRICS_LOG", "1") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))     # 0 - HTTP-ендпоінт /metrics вимкнено
+USER_AGENT = "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1"
+
+# --- МЕТРИКИ ТА ТАЙМІНГИ ---
+class Metrics:
+    """Спани етапів, лічильники HTTP-викликів/байтів і повторів. Потокобезпечно: розсилка йде з пулу."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float) # (ім'я, ((мітка, значення), ...)) -> значення, для /metrics
+        self.cycle = None
+        self.last_cycle = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+            if self.cycle is not None and name in ("bot_retries_total", "bot_engine_failures_total"):
+                tag = ",".join(str(v) for _, v in key[1])
+                self.cycle["retries"][tag] = self.cycle["retries"].get(tag, 0) + value
+
+    def http(self, endpoint, sent=0, received=0):
+        self.inc("bot_http_requests_total", endpoint=endpoint)
+        self.inc("bot_http_bytes_total", sent + received, endpoint=endpoint)
+        with self.lock:
+            if self.cycle is not None:
+                stat = self.cycle["http"].setdefault(endpoint, {"calls": 0, "bytes": 0})
+                stat["calls"] += 1
+                stat["bytes"] += sent + received
+
+    @contextmanager
+    def span(self, stage):
+        t0 = time.perf_counter()
+        try: yield
+        finally:
+            dur = time.perf_counter() - t0
+            self.inc("bot_stage_seconds_sum", dur, stage=stage)
+            self.inc("bot_stage_seconds_count", stage=stage)
+            with self.lock:
+                if self.cycle is not None:
+                    self.cycle["spans"][stage] = round(self.cycle["spans"].get(stage, 0) + dur * 1000, 3)
+
+    def begin_cycle(self):
+        with self.lock:
+            self.cycle = {"started": time.time(), "spans": {}, "http": {}, "retries": {}}
+
+    def end_cycle(self, branch):
+        with self.lock:
+            cycle, self.cycle = self.cycle, None
+        if cycle is None: return
+        duration = time.time() - cycle["started"]
+        self.inc("bot_cycles_total", branch=branch)
+        self.inc("bot_cycle_seconds_sum", duration)
+        with self.lock:
+            self.counters[("bot_last_cycle_seconds", ())] = duration
+            self.counters[("bot_last_cycle_timestamp", ())] = cycle["started"]
+        record = {"event": "cycle", "ts": datetime.fromtimestamp(cycle["started"]).isoformat(timespec="seconds"),
+                  "branch": branch, "duration_ms": round(duration * 1000, 3),
+                  "spans_ms": cycle["spans"], "http": cycle["http"], "retries": cycle["retries"]}
+        self.last_cycle = record
+        if METRICS_LOG: print(json.dumps(record, ensure_ascii=False))
+
+    def render(self):
+        """Текстовий формат Prometheus."""
+        lines = []
+        with self.lock:
+            items = sorted(self.counters.items())
+        for (name, labels), value in items:
+            label_txt = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{label_txt}}} {value:g}" if labels else f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args): pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port=METRICS_PORT):
+    if not port: return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"📈 [Метрики] /metrics на порту {port}.")
+    return server
 
 # --- РОБОТА З ПАМ'ЯТТЮ ---
+# Пам'ять: {"subscribers": {chat_id: {"provider", "group", "variant", "msg_ids", "user_ids", "last_imgs", "hours_by_date",
+#                                     "last_dates", "reminders", "reminder_id", "stub_date"}},
+#          "sources": {провайдер: {"hash", "etag", "modified", "day"}} - відбиток останньої обробленої сторінки,
+#          "images": індекс ImageCache (URL -> sha256 -> file_id),
+#          "history": версії графіків усіх груп по датах (див. record_history)}
+_saved_text = None # вміст файлу пам'яті на момент останнього читання/запису
+
+def new_subscriber(group="1.1", variant=2, provider="loe"):
+    return {"provider": provider, "group": group, "variant": variant, "msg_ids": [], "user_ids": [], "last_imgs": [], "hours_by_date": {}, "last_dates": [],
+            "reminders": True, "reminder_id": None, "stub_date": None}
+
+def _read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    return text, json.loads(text)
+
 def load_memory():
-    if os.path.exists(MEMORY_FILE):
+    """Читає стан; якщо основний файл пошкоджено - відновлює з резервної копії, а не скидає бота."""
+    global _saved_text
+    data = {}
+    for path in (MEMORY_FILE, MEMORY_FILE + ".bak"):
+        if not os.path.exists(path): continue
         try:
-            with open(MEMORY_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if "group" not in data or not data["group"]: data["group"] = "1.1"
-                if "variant" not in data: data["variant"] = 2
-                return data
-        except: pass
-    return {"group": "1.1", "variant": 2, "msg_ids": [], "last_imgs": [], "hours_by_date": {}, "last_dates": []}
-
-def save_memory(group, variant, msg_ids, last_imgs, hours_by_date, last_dates):
-    with open(MEMORY_FILE, "w", encoding="utf-8") as f:
-        json.dump({
-            "group": group, "variant": variant, "msg_ids": msg_ids, 
-            "last_imgs": last_imgs, "hours_by_date": hours_by_date, "last_dates": last_dates
-        }, f, ensure_ascii=False)
+            _saved_text, data = _read_json(path)
+            if path != MEMORY_FILE: print(f"♻️ [Пам'ять] Основний файл пошкоджено, відновлено з {path}.")
+            break
+        except Exception as e:
+            print(f"⚠️ [Пам'ять] Не вдалося прочитати {path}: {e}")
+            if path == MEMORY_FILE: os.replace(path, path + ".corrupt") # лишаємо для розбору, не перезаписуємо
+    if "subscribers" not in data:
+        # Старий формат (один чат) переносимо під TELEGRAM_CHAT_ID
+        subscribers = data["subscribers"] = {}
+        if CHAT_ID:
+            legacy = {k: data.pop(k) for k in new_subscriber() if k in data}
+            subscribers[str(CHAT_ID)] = {**new_subscriber(), **legacy}
+    for sub in data["subscribers"].values():
+        if not sub.get("group"): sub["group"] = "1.1"
+        if "variant" not in sub: sub["variant"] = 2
+        for k, v in new_subscriber().items(): sub.setdefault(k, v)
+    data.setdefault("history", {})
+    if "source" in data: data.setdefault("sources", {})["loe"] = data.pop("source") # до появи провайдерів
+    data.setdefault("sources", {})
+    if "stats" not in data: data["stats"] = build_stats(data["history"]) # разове заповнення з наявної історії
+    return data
+
+def _atomic_write(path, text):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _backup(path):
+    """.bak - жорстке посилання (або копія) на поточну версію; основний файл при цьому не зникає ні на мить,
+    його змінює лише os.replace в _atomic_write."""
+    tmp = f"{path}.bak.tmp"
+    if os.path.exists(tmp): os.remove(tmp)
+    try: os.link(path, tmp)
+    except OSError: shutil.copyfile(path, tmp) # ФС без жорстких посилань
+    os.replace(tmp, path + ".bak")
+
+def save_memory(mem):
+    """Один атомарний запис за цикл (temp + fsync + rename) і лише якщо стан змінився.
+    Попередня версія лишається в .bak. Повертає True, якщо був запис."""
+    global _saved_text
+    compact_history(mem["history"])
+    compact_stats(mem["stats"])
+    text = json.dumps(mem, ensure_ascii=False)
+    if text == _saved_text: return False
+    if os.path.exists(MEMORY_FILE): _backup(MEMORY_FILE)
+    _atomic_write(MEMORY_FILE, text)
+    _saved_text = text
+    return True
+
+# --- ІСТОРІЯ ВЕРСІЙ ГРАФІКІВ ---
+# history: {group: {date: [{"at", "site_time", "periods": [[start, end], ...]}, ...]}} - нова версія лише при зміні
+def group_key(provider, group):
+    """Ключ групи в історії, статистиці та нагадуваннях. Групи ЛОЕ - без префікса (сумісність зі старою пам'яттю)."""
+    return group if provider == "loe" else f"{provider}:{group}"
+
+def key_provider(key):
+    return key.split(":")[0] if ":" in key else "loe"
+
+def record_history(history, page):
+    """Додає нові версії та повертає їх: [(ключ групи, дата, маска, версія), ...] - для статистики і журналу."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    fresh = []
+    for i, groups in enumerate(page["parsed"]):
+        date_str = page["dates"][i]
+        site_time = page["times"][i] if i < len(page["times"]) else "00:00"
+        for group, info in groups.items():
+            group = group_key(page["provider"], group)
+            periods = [[p[0], p[1]] for p in info["periods"]]
+            versions = history.setdefault(group, {}).setdefault(date_str, [])
+            if versions and versions[-1]["periods"] == periods: continue
+            versions.append({"at": now, "site_time": site_time, "periods": periods})
+            fresh.append((group, date_str, info["mask"], versions[-1]))
+    return fresh
+
+def append_history_log(fresh):
+    """Повний журнал версій поза пам'яттю бота: один JSON-рядок на версію, файл лише дописується."""
+    if not HISTORY_LOG or not fresh: return
+    with open(HISTORY_LOG, "a", encoding="utf-8") as f:
+        for group, date_str, _, version in fresh:
+            f.write(json.dumps({"group": group, "date": date_str, **version}, ensure_ascii=False) + "\n")
+
+def compact_history(history, today=None):
+    """Старші за HISTORY_DAYS дати зводимо до фінальної версії, старші за HISTORY_KEEP_DAYS - видаляємо."""
+    today = today or datetime.now().date()
+    for dates in history.values():
+        for date_str in list(dates):
+            try: age = (today - datetime.strptime(date_str, "%d.%m.%Y").date()).days
+            except ValueError: age = HISTORY_KEEP_DAYS + 1
+            if age > HISTORY_KEEP_DAYS: del dates[date_str]
+            elif age > HISTORY_DAYS and len(dates[date_str]) > 1: dates[date_str] = dates[date_str][-1:]
+
+# --- СТАТИСТИКА ВІДКЛЮЧЕНЬ ---
+# stats: {group: {"days": {date: {"off", "outages", "longest", "changes"}},
+#                 "weeks": {"2026-W42": {...}}, "months": {"2026-10": {...}}}} - хвилини та лічильники.
+# Кожна нова версія графіка коригує добу та її тиждень/місяць на різницю зі старою версією - без повного перерахунку.
+STAT_FIELDS = ("off", "outages", "changes")
+
+def _buckets(day):
+    iso = day.isocalendar()
+    return (("weeks", f"{iso[0]}-W{iso[1]:02d}"), ("months", day.strftime("%Y-%m")))
+
+def update_stats(stats, group, date_str, mask):
+    try: day = datetime.strptime(date_str, "%d.%m.%Y").date()
+    except ValueError: return
+    runs = mask_runs(mask)
+    g = stats.setdefault(group, {"days": {}, "weeks": {}, "months": {}})
+    old = g["days"].get(date_str)
+    new = {"off": mask_minutes(mask), "outages": len(runs), "longest": max((e - s for s, e in runs), default=0),
+           "changes": old["changes"] + 1 if old else 0} # зміни після першої публікації
+    g["days"][date_str] = new
+    for kind, key in _buckets(day):
+        b = g[kind].setdefault(key, {"off": 0, "outages": 0, "longest": 0, "changes": 0, "days": 0})
+        for f in STAT_FIELDS: b[f] += new[f] - (old[f] if old else 0)
+        b["days"] += 0 if old else 1
+        if new["longest"] >= b["longest"]: b["longest"] = new["longest"]
+        elif old and old["longest"] == b["longest"]:
+            # максимум зменшився - перераховуємо лише по днях цього тижня/місяця
+            b["longest"] = max(d["longest"] for ds, d in g["days"].items()
+                               if (kind, key) in _buckets(datetime.strptime(ds, "%d.%m.%Y").date()))
+
+def periods_mask(periods):
+    mask = 0
+    for s, e in periods: mask |= span_mask(to_minutes(s), to_minutes(e))
+    return mask
+
+def build_stats(history):
+    stats = {}
+    for group, dates in history.items():
+        for date_str, versions in dates.items():
+            for v in versions:
+                update_stats(stats, group, date_str, periods_mask(v["periods"]))
+    return stats
+
+def compact_stats(stats, today=None):
+    """Добові підсумки старші за STATS_DAYS видаляємо; тижні та місяці лишаються."""
+    today = today or datetime.now().date()
+    for g in stats.values():
+        for date_str in list(g["days"]):
+            try: age = (today - datetime.strptime(date_str, "%d.%m.%Y").date()).days
+            except ValueError: age = STATS_DAYS + 1
+            if age > STATS_DAYS: del g["days"][date_str]
+
+def stats_report(stats, group, today=None):
+    """Звіт /stats: три готові записи (доба, тиждень, місяць), без обходу історії."""
+    today = today or datetime.now().date()
+    g = stats.get(group, {})
+    (_, week), (_, month) = _buckets(today)
+    rows = [("Сьогодні", g.get("days", {}).get(today.strftime("%d.%m.%Y"))),
+            (f"Тиждень {week[-3:]}", g.get("weeks", {}).get(week)), (f"Місяць {today.strftime('%m.%Y')}", g.get("months", {}).get(month))]
+    lines = [f"📊 <b>Статистика відключень, група {group.split(':')[-1]}</b>"]
+    for title, r in rows:
+        if not r:
+            lines.append(f"\n<b>{title}:</b> даних немає")
+            continue
+        lines.append(f"\n<b>{title}:</b>\n   🌑 Без світла: {fmt_minutes(r['off'])}\n   🔌 Відключень: {r['outages']}"
+                     f"\n   ⏳ Найдовше: {fmt_minutes(r['longest'])}\n   ✏️ Змін після публікації: {r['changes']}")
+    return "\n".join(lines)
+
+def set_state(sub, msg_ids, last_imgs, hours_by_date, last_dates):
+    sub.update({"msg_ids": msg_ids, "last_imgs": last_imgs, "hours_by_date": hours_by_date, "last_dates": last_dates})
 
 # --- МАТЕМАТИЧНІ ОБЧИСЛЕННЯ ---
-def calculate_duration(start, end):
+# Доба групи зберігається як 1440-бітна маска (біт = хвилина без світла), тривалості - хвилинами.
+DAY_MINUTES = 1440
+
+def to_minutes(hhmm):
     try:
-        fmt = "%H:%M"
-        end_proc = "23:59" if end == "24:00" else end
-        t1, t2 = datetime.strptime(start, fmt), datetime.strptime(end_proc, fmt)
-        diff = t2 - t1
-        s = diff.total_seconds()
-        if end == "24:00": s += 60
-        if s <= 0: return "0 г. 0 х."
-        return f"{int(s // 3600)} г. {int((s % 3600) // 60)} х."
-    except: return "0 г. 0 х."
+        h, m = hhmm.split(":")
+        return min(DAY_MINUTES, max(0, int(h) * 60 + int(m)))
+    except: return 0
+
+def fmt_minutes(minutes):
+    if minutes <= 0: return "0 г. 0 х."
+    return f"{minutes // 60} г. {minutes % 60} х."
+
+def span_mask(start_min, end_min):
+    if end_min <= start_min: return 0
+    return ((1 << end_min) - 1) ^ ((1 << start_min) - 1)
+
+def mask_minutes(mask):
+    return bin(mask).count("1")
+
+def mask_runs(mask):
+    """Суцільні відрізки встановлених бітів: [(start_min, end_min), ...] - об'єднані відключення."""
+    runs, offset = [], 0
+    while mask:
+        low = (mask & -mask).bit_length() - 1
+        mask >>= low
+        offset += low
+        length = (~mask & (mask + 1)).bit_length() - 1
+        runs.append((offset, offset + length))
+        mask >>= length
+        offset += length
+    return runs
 
 # --- ВІЗУАЛІЗАЦІЯ ЗМІН (ПІДКРЕСЛЕННЯ) ---
-def format_row(s, e, dur, old_data, is_new_date):
-    if is_new_date or not old_data or 'periods' not in old_data:
-        return f"   <b>{s} - {e}</b>   ({dur})"
-    old_periods = old_data['periods']
-    exact_match = any(p['start'] == s and p['end'] == e and p['dur'] == dur for p in old_periods)
-    if not exact_match:
-        s_disp = f"<u>{s}</u>" if not any(p['start'] == s for p in old_periods) else s
-        e_disp = f"<u>{e}</u>" if not any(p['end'] == e for p in old_periods) else e
-        d_disp = f"<u>{dur}</u>" if not any(p['dur'] == dur for p in old_periods) else dur
-        return f"   <b>{s_disp} - {e_disp}</b>   ({d_disp})"
-    return f"   <b>{s} - {e}</b>   ({dur})"
+NO_MARK = (False, False, False)
+
+def period_marks(old_periods, new_periods):
+    """Диф інтервалів: для кожного нового - що підкреслити (початок, кінець, тривалість).
+    Підкреслюється значення, якого не було серед старих інтервалів; точний збіг - без підкреслень.
+    Старі значення збираються в множини один раз, тож O(n + m) замість any() на кожен рядок."""
+    exact = {(p['start'], p['end'], p['dur']) for p in old_periods}
+    starts, ends, durs = ({p[k] for p in old_periods} for k in ('start', 'end', 'dur'))
+    return [NO_MARK if (p['start'], p['end'], p['dur']) in exact else
+            (p['start'] not in starts, p['end'] not in ends, p['dur'] not in durs) for p in new_periods]
+
+def format_row(s, e, dur, mark=NO_MARK):
+    s_disp, e_disp, d_disp = (f"<u>{v}</u>" if on else v for v, on in zip((s, e, dur), mark))
+    return f"   <b>{s_disp} - {e_disp}</b>   ({d_disp})"
+
+def date_changed(old_data, new_data):
+    """Чи треба оновити повідомлення дати: інші години групи чи статус 'світло є'.
+    Новий час 'станом на' сам по собі правки не вартий (перепублікація сайту дала б правку в кожному чаті),
+    він потрапляє в підпис разом із наступною змістовною правкою."""
+    return (old_data is None or old_data.get("periods") != new_data["periods"]
+            or old_data.get("is_full_light") != new_data["is_full_light"])
+
+def plan_changes(sub, dates, new_map, imgs):
+    """Мінімальний набір дій над повідомленнями підписника:
+    ("drop", mid) - дата зникла, ("edit", i, mid) - змінилась, ("append", i) - нова дата в кінці.
+    None - якщо правками порядок повідомлень не зберегти (тоді потрібна повна перебудова)."""
+    msg_ids, last_dates, old_map = sub["msg_ids"], sub["last_dates"], sub["hours_by_date"]
+    if not isinstance(msg_ids, list) or len(msg_ids) != len(last_dates): return None
+    old_pos = {d: k for k, d in enumerate(last_dates)}
+    ops = [("drop", mid) for d, mid in zip(last_dates, msg_ids) if d not in dates]
+    last_kept, appended = -1, False
+    for i, d in enumerate(dates[:len(imgs)]):
+        k = old_pos.get(d)
+        if k is None:
+            ops.append(("append", i))
+            appended = True
+        elif appended or k < last_kept: return None # стара дата опинилась після нової - не переставити
+        else:
+            last_kept = k
+            if date_changed(old_map.get(d), new_map[d]): ops.append(("edit", i, msg_ids[k]))
+    return ops
 
 # --- ПАРСИНГ ТА РОЗРАХУНОК ---
-def extract_group_info(text_block, group, old_data=None):
-    if not group: return "", {}
-    pattern = rf"Група {group}\.(.*?)(?=Група \d\.\d|$)"
-    match = re.search(pattern, text_block, re.DOTALL)
+def render_group_info(info, old_data=None):
+    """HTML-текст та дані для пам'яті з розібраної групи (підкреслення - відносно old_data)."""
     current_data = {"periods": [], "light_before": None, "light_after_last": None, "is_full_light": False}
     is_new_date = old_data is None
-    if match:
-        content = match.group(1).strip()
-        if "Електроенергія є." in content and "немає" not in content:
-            current_data["is_full_light"] = True
-            was_off = old_data and (len(old_data.get("periods", [])) > 0 or not old_data.get("is_full_light", True))
-            status = "✅ <b><u>Електроенергія є.</u></b>" if was_off and not is_new_date else "✅ <b>Електроенергія є.</b>"
-            return status, current_data
-        all_matches = re.findall(r"(\d{2}:\d{2}) до (\d{2}:\d{2})", content)
-        for s, e in all_matches:
-            current_data["periods"].append({"start": s, "end": e, "dur": calculate_duration(s, e), "light_after": None})
-        if current_data["periods"]:
-            was_full_light = old_data.get("is_full_light", False) if old_data else False
-            header = "⚠️ <b><u>Планове відключення:</u></b>" if was_full_light and not is_new_date else "⚠️ <b>Планове відключення:</b>"
-            res_lines = [header]
-            
-            # ВИПРАВЛЕНО: беремо перший елемент списку [0]
-            first_p = current_data["periods"][0] 
-            l_dur = calculate_duration("00:00", first_p["start"])
-            current_data["light_before"] = l_dur
-            old_l = old_data.get("light_before") if old_data else None
-            l_disp = f"<u>{l_dur}</u>" if not is_new_date and l_dur != old_l else l_dur
-            res_lines.append(f"          💡  <i>{l_disp}</i>")
-
-            
-            prev_end = None
-            for i, p in enumerate(current_data["periods"]):
-                if prev_end:
-                    l_dur = calculate_duration(prev_end, p["start"])
-                    current_data["periods"][i-1]["light_after"] = l_dur
-                    old_l = old_data["periods"][i-1].get("light_after") if old_data and i-1 < len(old_data["periods"]) else None
-                    l_disp = f"<u>{l_dur}</u>" if not is_new_date and l_dur != old_l else l_dur
-                    res_lines.append(f"          💡  <i>{l_disp}</i>")
-                res_lines.append(format_row(p["start"], p["end"], p["dur"], old_data, is_new_date))
-                prev_end = p["end"]
-            
-            last_e = current_data["periods"][-1]["end"]
-            l_dur = calculate_duration(last_e, "24:00")
-            current_data["light_after_last"] = l_dur
-            old_l = old_data.get("light_after_last") if old_data else None
-            l_disp = f"<u>{l_dur}</u>" if not is_new_date and l_dur != old_l else l_dur
-            res_lines.append(f"          💡  <i>{l_disp}</i>")
-            return "\n".join(res_lines), current_data
-    return "", current_data
+    if not info: return "", current_data
+    if info["is_full_light"]:
+        current_data["is_full_light"] = True
+        current_data["off_minutes"] = 0
+        was_off = old_data and (len(old_data.get("periods", [])) > 0 or not old_data.get("is_full_light", True))
+        status = "✅ <b><u>Електроенергія є.</u></b>" if was_off and not is_new_date else "✅ <b>Електроенергія є.</b>"
+        return status, current_data
+    periods = info["periods"]
+    if not periods: return "", current_data
+    for s, e, s_min, e_min in periods:
+        current_data["periods"].append({"start": s, "end": e, "dur": fmt_minutes(e_min - s_min), "light_after": None})
+    current_data["off_minutes"] = mask_minutes(info["mask"])
+
+    was_full_light = old_data.get("is_full_light", False) if old_data else False
+    header = "⚠️ <b><u>Планове відключення:</u></b>" if was_full_light and not is_new_date else "⚠️ <b>Планове відключення:</b>"
+    res_lines = [header]
+
+    def light_line(l_dur, old_l):
+        l_disp = f"<u>{l_dur}</u>" if not is_new_date and l_dur != old_l else l_dur
+        res_lines.append(f"          💡  <i>{l_disp}</i>")
+
+    l_dur = fmt_minutes(periods[0][2])
+    current_data["light_before"] = l_dur
+    light_line(l_dur, old_data.get("light_before") if old_data else None)
+
+    marks = period_marks(old_data.get("periods", []), current_data["periods"]) if old_data else None
+    for i, p in enumerate(current_data["periods"]):
+        if i:
+            l_dur = fmt_minutes(periods[i][2] - periods[i - 1][3])
+            current_data["periods"][i - 1]["light_after"] = l_dur
+            light_line(l_dur, old_data["periods"][i - 1].get("light_after") if old_data and i - 1 < len(old_data["periods"]) else None)
+        res_lines.append(format_row(p["start"], p["end"], p["dur"], marks[i] if marks else NO_MARK))
+
+    l_dur = fmt_minutes(DAY_MINUTES - periods[-1][3])
+    current_data["light_after_last"] = l_dur
+    light_line(l_dur, old_data.get("light_after_last") if old_data else None)
+    return "\n".join(res_lines), current_data
+
+def extract_group_info(text_block, group, old_data=None):
+    if not group: return "", {}
+    return render_group_info(LOE_PARSER.parse_block(text_block).get(group), old_data)
+
+# --- ЗАВАНТАЖЕННЯ ГРАФІКІВ (ДВИГУНИ) ---
+# Кожен двигун повертає знімок сторінки {"engine", "status", "text", "imgs", "fingerprint"} або None.
+# status: "ok" - графіки є, "empty" - сторінка жива, але графіків немає (Provider.status),
+#         "unchanged" - сервер відповів 304 на умовний запит (джерело не змінилось).
+class _TextExtractor(HTMLParser):
+    BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS: self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS: self.parts.append("\n")
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+def html_to_text(html):
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    lines = (re.sub(r"[ \t\xa0]+", " ", l).strip() for l in "".join(parser.parts).split("\n"))
+    return "\n".join(l for l in lines if l)
+
+def fingerprint(full_text, imgs):
+    return hashlib.sha256("\n".join([full_text, *imgs]).encode("utf-8")).hexdigest()
+
+# --- СЕСІЯ ЗАВАНТАЖЕННЯ (ЖИВЕ МІЖ ЦИКЛАМИ) ---
+class FetchSession:
+    """HTTP-сесія та теплий браузер, що переживають цикли; перезапускаються кожні N циклів або після збою."""
+
+    def __init__(self, recycle_after=RECYCLE_AFTER):
+        self.recycle_after = recycle_after
+        self.http = None
+        self.driver = None
+        self.cycles = 0
+
+    def get_http(self):
+        if self.http is None:
+            self.http = requests.Session()
+            self.http.headers["User-Agent"] = USER_AGENT
+        return self.http
+
+    def get_driver(self):
+        if self.driver is None:
+            from selenium import webdriver
+            from selenium.webdriver.chrome.service import Service
+            from selenium.webdriver.chrome.options import Options
+            from webdriver_manager.chrome import ChromeDriverManager
+            print("🌐 [Браузер] Запуск headless Chrome...")
+            options = Options()
+            options.add_argument("--headless=new")
+            options.add_argument("--window-size=390,1200")
+            options.add_argument(f"user-agent={USER_AGENT}")
+            with metrics.span("browser_start"):
+                self.driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
+        return self.driver
+
+    def end_cycle(self, failed=False):
+        self.cycles += 1
+        if failed or self.cycles >= self.recycle_after:
+            print(f"♻️ [Сесія] Перезапуск ({'збій' if failed else f'{self.cycles} циклів'}).")
+            self.close()
+
+    def close(self):
+        if self.driver:
+            try: self.driver.quit()
+            except Exception: pass
+            self.driver = None
+            print("🔌 [Браузер] Сесію завершено.")
+        if self.http:
+            self.http.close()
+            self.http = None
+        self.cycles = 0
+
+# --- TELEGRAM-КЛІЄНТ ---
+class TokenBucket:
+    """Ліміт частоти запитів, спільний для всіх потоків; pause() - глобальна пауза після 429."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class TelegramClient:
+    """Bot API через одну keep-alive сесію: таймаути, повтори, повага до 429 retry_after."""
+
+    def __init__(self, token=TOKEN, base=TG_API, rate=TG_RATE):
+        self.base = f"{base}{token}"
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(4, SEND_WORKERS * 2))
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        self.bucket = TokenBucket(rate)
+
+    def call(self, method, data=None, files=None, timeout=TG_TIMEOUT):
+        """Повертає JSON-відповідь Telegram; мережеві збої та 5xx повторюються, 429 - після retry_after."""
+        for attempt in range(TG_RETRIES + 1):
+            self.bucket.acquire()
+            try:
+                for f in (files or {}).values():
+                    if hasattr(f[1], "seek"): f[1].seek(0) # повтор має відправити файл з початку
+                r = self.http.post(f"{self.base}/{method}", data=data, files=files, timeout=timeout)
+                metrics.http(f"telegram.{method}", len(r.request.body or b""), len(r.content))
+                resp = r.json()
+            except (requests.RequestException, ValueError) as e:
+                if attempt == TG_RETRIES: raise
+                metrics.inc("bot_retries_total", kind="telegram_error")
+                print(f"⚠️ [Telegram] {method}: {e}. Повтор {attempt + 1}/{TG_RETRIES}...")
+                time.sleep(2 ** attempt)
+                continue
+            if r.status_code == 429 or resp.get("error_code") == 429:
+                retry_after = resp.get("parameters", {}).get("retry_after", 1 + attempt)
+                print(f"⏳ [Telegram] 429 на {method}, чекаю {retry_after} с.")
+                metrics.inc("bot_retries_total", kind="telegram_429")
+                self.bucket.pause(retry_after)
+                continue
+            if r.status_code >= 500 and attempt < TG_RETRIES:
+                metrics.inc("bot_retries_total", kind="telegram_5xx")
+                time.sleep(2 ** attempt)
+                continue
+            return resp
+        return resp
+
+    def ok(self, resp):
+        """Успіх виклику; правка без змін (400 'message is not modified') - теж успіх: повідомлення вже актуальне."""
+        return bool(resp.get("ok")) or "message is not modified" in str(resp.get("description", ""))
+
+    def message_id(self, resp):
+        result = resp.get("result")
+        return result.get("message_id") if isinstance(result, dict) else None
+
+    def delete_messages(self, chat_id, ids):
+        """Масове видалення: до 100 ID за один виклик deleteMessages."""
+        ids = sorted({int(i) for i in ids if i})
+        for k in range(0, len(ids), 100):
+            self.call("deleteMessages", {"chat_id": chat_id, "message_ids": json.dumps(ids[k:k + 100])})
+        return len(ids)
+
+tg = TelegramClient()
+
+# --- ЛОКАЛЬНИЙ РЕНДЕР ГРАФІКА (PNG) ---
+# Посилання на рендер містить усе для малювання: "render:<група>:<дата>:<відрізки хв>|light|none".
+# Однаковий графік -> однакове посилання -> один рендер і один file_id на всіх підписників.
+RENDER_PREFIX = "render:"
+RENDER_PALETTE = [(255, 255, 255), (40, 40, 40), (214, 69, 65), (255, 221, 87), (200, 200, 200)] # фон, текст, немає, є, невідомо
+FONT = {"0": "111101101101111", "1": "010110010010111", "2": "111001111100111", "3": "111001111001111",
+        "4": "101101111001001", "5": "111100111001111", "6": "111100111101111", "7": "111001010010010",
+        "8": "111101111101111", "9": "111101111001111", ".": "000000000000010", ":": "000010000010000",
+        "-": "000000111000000", " ": "000000000000000"}
+R_PAD, R_HOUR, R_TOP, R_BAR = 16, 24, 44, 56 # відступ, ширина години, верх смуги, висота смуги (px)
+
+def render_ref(group, date_str, info):
+    if not info: body = "none"
+    elif info["is_full_light"]: body = "light"
+    else: body = ",".join(f"{s}-{e}" for s, e in mask_runs(info["mask"]))
+    return f"{RENDER_PREFIX}{group}:{date_str}:{body}"
+
+def img_url(img, site=URL_SITE):
+    return img if img.startswith(RENDER_PREFIX) else urljoin(site, img)
+
+def _draw_text(canvas, x, y, text, scale, color=1):
+    for ch in text:
+        bits = FONT.get(ch, FONT[" "])
+        for k, b in enumerate(bits):
+            if b == "1":
+                for dy in range(scale):
+                    row = canvas[y + (k // 3) * scale + dy]
+                    row[x + (k % 3) * scale:x + (k % 3 + 1) * scale] = bytes([color]) * scale
+        x += 4 * scale
+
+def render_schedule_png(ref):
+    """Добова смуга 00-24 для однієї групи: червоне - відключення, жовте - світло. Палітровий PNG."""
+    group, date_str, body = ref[len(RENDER_PREFIX):].split(":", 2)
+    width, height = 2 * R_PAD + 24 * R_HOUR, R_TOP + R_BAR + 30
+    off = 0
+    if body not in ("none", "light") and body:
+        for run in body.split(","):
+            s, e = run.split("-")
+            off |= span_mask(int(s), int(e))
+    bar = bytearray(width)
+    for x in range(R_PAD, width - R_PAD):
+        minute = (x - R_PAD) * 60 // R_HOUR
+        bar[x] = 4 if body == "none" else 2 if off >> minute & 1 else 3
+    for h in range(25): bar[min(R_PAD + h * R_HOUR, width - R_PAD - 1)] = 1 if h % 6 == 0 else 0
+    canvas = [bytearray(width) for _ in range(height)]
+    for y in range(R_TOP, R_TOP + R_BAR): canvas[y][:] = bar
+    for y in (R_TOP, R_TOP + R_BAR - 1): canvas[y][R_PAD:width - R_PAD] = bytes([1]) * (width - 2 * R_PAD)
+    _draw_text(canvas, R_PAD, 12, f"{group}   {date_str}", 4)
+    for h in range(0, 25, 3):
+        label = f"{h:02d}"
+        _draw_text(canvas, R_PAD + h * R_HOUR - len(label) * 4, R_TOP + R_BAR + 10, label, 2)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    raw = b"".join(b"\x00" + bytes(row) for row in canvas)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+            + chunk(b"PLTE", bytes(c for rgb in RENDER_PALETTE for c in rgb))
+            + chunk(b"IDAT", zlib.compress(raw, 9)) + chunk(b"IEND", b""))
+
+# --- КЕШ КАРТИНОК (URL -> SHA-256 -> file_id) ---
+class ImageCache:
+    """Повторна відправка картинки - за file_id Telegram, без завантаження з сайту та вивантаження.
+    Індекс живе в пам'яті бота: {"urls": {url: {"sha", "etag", "modified"}}, "blobs": {sha: {"file_id", "size", "used"}}}.
+    Розсилка йде з пулу потоків: усі зміни індексу та файлів - під self.lock, а картинки URL, які зараз
+    надсилаються (self.busy), витісненню не підлягають."""
+
+    def __init__(self, directory=IMG_CACHE_DIR, max_bytes=IMG_CACHE_MAX):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = {"urls": {}, "blobs": {}}
+        self.http = None
+        self.lock = threading.Lock()
+        self.url_locks = defaultdict(threading.Lock)
+        self.busy = defaultdict(int) # url -> кількість незавершених send_photo
+
+    def attach(self, index):
+        index.setdefault("urls", {})
+        index.setdefault("blobs", {})
+        with self.lock: self.index = index
+
+    def path(self, sha):
+        return os.path.join(self.directory, f"{sha}.png")
+
+    def _store(self, url, tmp, sha, meta):
+        """Файл і запис в індексі з'являються разом, під замком - витіснення не побачить половину."""
+        with self.lock:
+            os.replace(tmp, self.path(sha))
+            self.index["urls"][url] = {"sha": sha, **meta}
+            blob = self.index["blobs"].setdefault(sha, {})
+            blob.update(size=os.path.getsize(self.path(sha)), used=time.time())
+        return sha
+
+    def _cached(self, url):
+        """sha картинки URL, якщо її файл ще на диску (URL зайнятий - файл уже не зникне)."""
+        with self.lock:
+            sha = self.index["urls"].get(url, {}).get("sha")
+            return sha if sha in self.index["blobs"] and os.path.exists(self.path(sha)) else None
+
+    def download(self, url):
+        """Умовне потокове завантаження. Повертає sha256 вмісту (файл лежить у self.path(sha))."""
+        if url.startswith(RENDER_PREFIX): return self.render(url)
+        if self.http is None:
+            self.http = requests.Session()
+            self.http.headers["User-Agent"] = USER_AGENT
+        cached = self._cached(url)
+        meta = self.index["urls"].get(url, {}) if cached else {}
+        headers = {}
+        if meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+        if meta.get("modified"): headers["If-Modified-Since"] = meta["modified"]
+        with self.http.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as r:
+            if r.status_code == 304 and headers:
+                metrics.http("image")
+                return cached
+            r.raise_for_status()
+            os.makedirs(self.directory, exist_ok=True)
+            hasher, tmp = hashlib.sha256(), os.path.join(self.directory, f".{threading.get_ident()}.part")
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(64 * 1024):
+                    hasher.update(chunk)
+                    f.write(chunk)
+            metrics.http("image", received=os.path.getsize(tmp))
+            return self._store(url, tmp, hasher.hexdigest(), {"etag": r.headers.get("ETag"), "modified": r.headers.get("Last-Modified")})
+
+    def render(self, ref):
+        """Локальний рендер; ключ кешу - саме посилання (група, дата, відрізки), тож повтор не малюється."""
+        cached = self._cached(ref)
+        if cached: return cached
+        png = render_schedule_png(ref)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, f".{threading.get_ident()}.part")
+        with open(tmp, "wb") as f: f.write(png)
+        metrics.inc("bot_renders_total")
+        return self._store(ref, tmp, hashlib.sha256(png).hexdigest(), {})
+
+    def send_photo(self, chat_id, url, caption, message_id=None):
+        """sendPhoto, або editMessageMedia якщо задано message_id (заміна картинки з підписом одним викликом)."""
+        with self.lock: self.busy[url] += 1
+        sha = None
+        try:
+            with self.url_locks[url]: # паралельні підписники чекають на перше вивантаження і беруть його file_id
+                with self.lock:
+                    sha = self.index["urls"].get(url, {}).get("sha")
+                    file_id = self.index["blobs"].get(sha, {}).get("file_id")
+                if file_id:
+                    r = self._photo_call(chat_id, caption, message_id, file_id)
+                    if r.get("ok"): return r
+                    print(f"⚠️ [Кеш] file_id для {url} не спрацював, вивантажую заново.")
+                    with self.lock: self.index["blobs"].get(sha, {}).pop("file_id", None)
+                sha = self.download(url)
+                with open(self.path(sha), "rb") as f:
+                    r = self._photo_call(chat_id, caption, message_id, upload=f)
+                result = r.get("result")
+                photos = result.get("photo") if isinstance(result, dict) else None
+                if photos:
+                    with self.lock: self.index["blobs"][sha]["file_id"] = photos[-1]["file_id"]
+                return r
+        finally:
+            with self.lock:
+                self.busy[url] -= 1
+                if not self.busy[url]: del self.busy[url]
+                if sha in self.index["blobs"]: self.index["blobs"][sha]["used"] = time.time()
+                self.evict()
+
+    def _photo_call(self, chat_id, caption, message_id, file_id=None, upload=None):
+        files = {'photo': ('g.png', upload)} if upload else None
+        if message_id is None:
+            data = {'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'}
+            if file_id: data['photo'] = file_id
+            return tg.call("sendPhoto", data, files=files)
+        media = {"type": "photo", "media": file_id or "attach://photo", "caption": caption, "parse_mode": "HTML"}
+        return tg.call("editMessageMedia", {'chat_id': chat_id, 'message_id': message_id, 'media': json.dumps(media)}, files=files)
+
+    def evict(self):
+        """LRU під self.lock: спершу старі файли понад IMG_CACHE_MAX, потім старі записи понад IMG_INDEX_MAX.
+        Картинки URL, що зараз надсилаються, не чіпаємо."""
+        urls, blobs = self.index["urls"], self.index["blobs"]
+        in_use = {urls[u].get("sha") for u in self.busy if u in urls}
+        by_age = sorted((k for k in blobs if k not in in_use), key=lambda k: blobs[k].get("used", 0))
+        on_disk = [k for k in blobs if os.path.exists(self.path(k))]
+        total = sum(blobs[k].get("size", 0) for k in on_disk)
+        for k in by_age:
+            if total <= self.max_bytes: break
+            if k not in on_disk: continue
+            os.remove(self.path(k))
+            total -= blobs[k].get("size", 0)
+        for k in by_age[:max(0, len(blobs) - IMG_INDEX_MAX)]:
+            del blobs[k]
+            if os.path.exists(self.path(k)): os.remove(self.path(k))
+        for url in [u for u, m in urls.items() if m.get("sha") not in blobs]:
+            del urls[url]
+
+image_cache = ImageCache()
 
 # --- ОЧИЩЕННЯ ЧАТУ ---
-def clear_chat_5(msg_ids):
-    print("🧹 [Дія] Початок повної зачистки чату перед оновленням...")
+def clear_chat_5(sub, chat_id):
+    """Видаляє лише відомі повідомлення: надіслані ботом (msg_ids, reminder_id) та побачені від користувача (user_ids)."""
+    print(f"🧹 [Дія] [{chat_id}] Початок повної зачистки чату перед оновленням...")
     try:
-        r = requests.post(f"https://api.telegram.org{TOKEN}/sendMessage", data={'chat_id': CHAT_ID, 'text': '.'}).json()
-        last_id = r.get('result', {}).get('message_id')
-        if not last_id: return
-        if msg_ids:
-            start_id = min(msg_ids)
-            print(f"🗑 [Процес] Видалення повідомлень від ID {start_id} до ID {last_id} (включно).")
-            for mid in range(start_id, last_id + 1):
-                requests.post(f"https://api.telegram.org{TOKEN}/deleteMessage", data={'chat_id': CHAT_ID, 'message_id': mid})
-        else:
-            print("🗑 [Процес] Графіків не знайдено, видаляємо останні 5 повідомлень чату.")
-            for i in range(last_id, last_id - 6, -1):
-                requests.post(f"https://api.telegram.org{TOKEN}/deleteMessage", data={'chat_id': CHAT_ID, 'message_id': i})
-        time.sleep(1)
+        ids = list(sub["msg_ids"]) + list(sub.get("user_ids", [])) + [sub.get("reminder_id")]
+        if any(ids):
+            print(f"🗑 [Процес] Видалення {len([i for i in ids if i])} повідомлень.")
+            tg.delete_messages(chat_id, ids)
+        sub["user_ids"], sub["reminder_id"] = [], None
         print("✨ [Результат] Чат очищено успішно.")
     except Exception as e: print(f"⚠️ [Помилка] Під час очищення: {e}")
 
-# --- ГОЛОВНА ЛОГІКА ---
-def check_and_update():
-    print(f"🕒 [{datetime.now().strftime('%H:%M:%S')}] --- ЗАПУСК ПЕРЕВІРКИ ---")
-    mem = load_memory()
-    current_group, current_variant = mem["group"], mem["variant"]
-    msg_ids, last_imgs = mem["msg_ids"], mem["last_imgs"]
-    hours_by_date, last_dates = mem["hours_by_date"], mem["last_dates"]
-    
-    user_interfered = False
+# --- ПРОВАЙДЕРИ (АДАПТЕРИ САЙТІВ ОБЛЕНЕРГО) ---
+# Спільна модель сторінки (Provider.analyze): {"provider", "site", "dates", "times", "imgs",
+#   "parsed": [{група: {"is_full_light", "periods": [(s, e, s_min, e_min)], "mask"}}, ...], "valid", "footer_date", "day"}
+class Provider:
+    """Адаптер одного сайту. Підклас задає name/site і реалізує:
+    engines - {назва: метод(session, source) -> знімок або None}, черговість - з FETCH_ENGINES;
+    status(full_text) - "ok" (графіки є) / "empty" (сторінка жива, графіків немає) / None (сторінка не та);
+    analyze(snap) - розбір знімка у спільну модель сторінки."""
+    name, site, timeout = "", "", PROVIDER_TIMEOUT
+    engines = {}
 
+    def fetch(self, session, source=None):
+        """Пробує двигуни по черзі; наступний стартує лише якщо попередній не впорався.
+        source - відбиток попереднього циклу для умовного запиту (ETag/Last-Modified)."""
+        for name in FETCH_ENGINES:
+            engine = self.engines.get(name)
+            if not engine:
+                print(f"⚠️ [Крок 2] [{self.name}] Двигун '{name}' не підтримується, пропускаю.")
+                continue
+            try:
+                with metrics.span(f"fetch_{name}"):
+                    snap = engine(session, source)
+                if snap:
+                    print(f"✅ [Крок 2] [{self.name}] Сторінку отримано двигуном '{name}' ({snap['status']}).")
+                    return snap
+                print(f"⚠️ [Крок 2] [{self.name}] Двигун '{name}' не знайшов ні графіків, ні ознак живої сторінки.")
+                metrics.inc("bot_engine_failures_total", engine=name)
+            except Exception as e:
+                print(f"⚠️ [Крок 2] [{self.name}] Двигун '{name}' впав: {e}")
+                metrics.inc("bot_engine_failures_total", engine=name)
+                if name == "selenium": session.close() # браузер міг зависнути — наступний цикл почне з чистого
+        return None
 
+class LoeProvider(Provider):
+    """Львівобленерго: API poweron.loe.lviv.ua з браузером як запасом, блоки 'Графік погодинних відключень на ...'."""
+    name, site, api_url = "loe", URL_SITE, URL_API
+    GROUP_RE = re.compile(r"Група (\d\.\d)(\.)?")
+    PERIOD_RE = re.compile(r"(\d{2}:\d{2}) до (\d{2}:\d{2})")
+    DATE_RE = re.compile(r"відключень на (\d{2}\.\d{2}\.\d{4})")
+    TIME_RE = re.compile(r"станом на (\d{2}:\d{2})")
+    BLOCK_HEAD = "Графік погодинних відключень на"
+    EMPTY_MARK = 'НЕК "Укренерго"'   # сторінка без графіків, але жива
+    IMAGE_MARK = "_GPV-mobile.png"
 
-    user_commands_log = [] # Список для збору текстів користувача
-    print("📩 [Крок 1] Перевірка повідомлень...")
-    try:
-        # Визначаємо останній ID від бота
-        last_bot_mid = max(msg_ids) if msg_ids and isinstance(msg_ids, list) else (msg_ids if isinstance(msg_ids, int) else 0)
-        
-        url = f"https://api.telegram.org{TOKEN}/getUpdates"
-        resp = requests.get(url, params={'limit': 10, 'offset': -10}).json()
-
-        if resp.get('result'):
-            for upd in resp['result']:
-                msg_obj = upd.get('message', {})
-                m_text = msg_obj.get('text', '').strip()
-                m_id = msg_obj.get('message_id', 0)
-
-                # Будь-яка активність після бота активує повну зачистку чату
-                if m_id > last_bot_mid:
-                    user_interfered = True
-                    user_commands_log.append(f"'{m_text}'") # Фіксуємо текст для звіту
-                    
-                    # Зміна налаштувань тільки за суворими командами з "/"
-                    if m_text.startswith("/"):
-                        if m_text == "/1": 
-                            current_variant = 1
-                            print("🔄 [Зміна] Обрано ВАРІАНТ 1 (Фото).")
-                        elif m_text == "/2": 
-                            current_variant = 2
-                            print("🔄 [Зміна] Обрано ВАРІАНТ 2 (Текст).")
-                        
-                        g_match = re.search(r"^/(\d\.\d)$", m_text)
-                        if g_match:
-                            current_group = g_match.group(1)
-                            hours_by_date, last_dates = {}, []
-                            print(f"🎯 [Зміна] Обрано ГРУПУ {current_group}. Пам'ять скинуто.")
-                    else:
-                        print(f"🧹 [Дія] Помічено звичайний текст: '{m_text}'. Чат буде очищено.")
-
-            # Підтверджуємо отримання, щоб не обробляти ці повідомлення знову
-            l_upd = resp['result'][-1]['update_id']
-            requests.get(url, params={'offset': l_upd + 1})
-
-        save_memory(current_group, current_variant, msg_ids, last_imgs, hours_by_date, last_dates)
-    except Exception as e:
-        print(f"⚠️ [Крок 1] Помилка: {e}")
-    
-    
+    def __init__(self):
+        self.engines = {"http": self.fetch_http, "selenium": self.fetch_selenium}
 
-    
-    driver = None
-    try:
-        print(f"🌐 [Крок 2] Запуск браузера та завантаження {URL_SITE} ...")
-        options = Options()
-        options.add_argument("--headless=new")
-        options.add_argument("--window-size=390,1200")
-        options.add_argument("user-agent=Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.6 Mobile/15E148 Safari/604.1")
-        driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-        #driver.get(URL_SITE)
-        #time.sleep(10)
-
-
-    # --- КРОК 2: ЗАВАНТАЖЕННЯ САЙТУ ---
-    #driver = None
-    #try:
-    #    # ... налаштування options ...
-    #    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    #    print(f"🌐 [Крок 2] Завантаження {URL_SITE}...")
-        driver.get(URL_SITE)
-        
-        site_valid = False
-        content_found = False
+    def status(self, full_text):
+        if "відключень на" in full_text.lower(): return "ok"
+        if self.EMPTY_MARK in full_text: return "empty"
+        return None
+
+    def fetch_http(self, session, source=None):
+        """Дані з API, з якого сайт сам підтягує графіки: без браузера, один (умовний) GET."""
+        headers = {"Accept": "application/ld+json, application/json"}
+        if source and source.get("etag"): headers["If-None-Match"] = source["etag"]
+        if source and source.get("modified"): headers["If-Modified-Since"] = source["modified"]
+        r = session.get_http().get(self.api_url, headers=headers, timeout=HTTP_TIMEOUT)
+        metrics.http(f"{self.name}_api", received=len(r.content))
+        if r.status_code == 304 and source:
+            return {"engine": "http", "status": "unchanged", "fingerprint": source.get("hash")}
+        r.raise_for_status()
+        data = r.json()
+        menus = data.get("hydra:member", []) if isinstance(data, dict) else data
+        texts, imgs, all_imgs = [], [], []
+        for menu in menus:
+            for item in menu.get("menuItems", []):
+                raw = item.get("rawMobileHtml") or item.get("rawHtml") or ""
+                if raw: texts.append(html_to_text(raw))
+                img = item.get("imageUrl")
+                if not img: continue
+                img = urljoin(self.api_url, img)
+                all_imgs.append(img)
+                if self.IMAGE_MARK in img: imgs.append(img)
+        full_text = "\n".join(texts)
+        status = self.status(full_text)
+        if not status: return None
+        imgs = imgs or all_imgs
+        return {"engine": "http", "status": status, "text": full_text, "imgs": imgs, "fingerprint": fingerprint(full_text, imgs),
+                "etag": r.headers.get("ETag"), "modified": r.headers.get("Last-Modified")}
+
+    def fetch_selenium(self, session, source=None):
+        """Запасний двигун: повноцінний headless Chrome (імпортується лише за потреби)."""
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException
 
+        driver = session.get_driver()
+        with metrics.span("browser_page_load"):
+            driver.get(self.site)
+        metrics.http(f"{self.name}_site_browser")
+
+        status = None
         for attempt in range(2):
             try:
                 # 1. Чекаємо "відключень на" 15 секунд
                 WebDriverWait(driver, 15).until(
-                    lambda d: "відключень на" in d.find_element(By.TAG_NAME, "body").text.lower()
+                    lambda d: self.status(d.find_element(By.TAG_NAME, "body").text) == "ok"
                 )
-                site_valid = True
-                content_found = True
+                status = "ok"
                 print(f"✅ [Успіх] Графіки знайдено (спроба {attempt + 1}).")
                 break
             except TimeoutException:
                 # 2. Якщо графіків немає, перевіряємо "НЕК "Укренерго""
-                full_text = driver.find_element(By.TAG_NAME, "body").text
-                if 'НЕК "Укренерго"' in full_text:
-                    site_valid = False # Сайт живий, графіків просто немає
-                    content_found = True
+                if self.status(driver.find_element(By.TAG_NAME, "body").text) == "empty":
+                    status = "empty" # Сайт живий, графіків просто немає
                     print(f"ℹ️ [Сайт] Графіки відсутні, але сторінка завантажена (є 'Укренерго').")
                     break
+                # 3. Якщо нічого немає — рефреш
+                if attempt == 0:
+                    print("🔄 [Помилка] Немає ні графіків, ні 'Укренерго'. Перезавантажую...")
+                    metrics.inc("bot_retries_total", kind="selenium_refresh")
+                    driver.refresh()
+                    time.sleep(5)
                 else:
-                    # 3. Якщо нічого немає — рефреш
-                    if attempt == 0:
-                        print("🔄 [Помилка] Немає ні графіків, ні 'Укренерго'. Перезавантажую...")
-                        driver.refresh()
-                        time.sleep(5)
-                    else:
-                        print("🛑 [Стоп] Сайт не завантажився навіть після рефрешу.")
-                        return # Вихід із функції (цикл зупиниться)
-
-        if not content_found: return
-
+                    print("🛑 [Стоп] Сайт не завантажився навіть після рефрешу.")
 
+        if not status: return None
         full_text = driver.find_element(By.TAG_NAME, "body").text
-        current_dates = re.findall(r"відключень на (\d{2}\.\d{2}\.\d{4})", full_text)
-        found_times = re.findall(r"станом на (\d{2}:\d{2})", full_text)
-        imgs_elements = driver.find_elements(By.XPATH, "//img[contains(@src, '_GPV-mobile.png')]")
-        current_imgs = [img.get_attribute("src") for img in imgs_elements]
-        blocks = re.split(r"Графік погодинних відключень на", full_text)[1:]
-        print(f"📊 [Аналіз] На сайті знайдено графіків: {len(current_dates)}.")
+        imgs_elements = driver.find_elements(By.XPATH, f"//img[contains(@src, '{self.IMAGE_MARK}')]")
+        imgs = [img.get_attribute("src") for img in imgs_elements]
+        return {"engine": "selenium", "status": status, "text": full_text, "imgs": imgs, "fingerprint": fingerprint(full_text, imgs)}
+
+    def parse_block(self, text_block):
+        """Один прохід по блоку 'Графік погодинних відключень на ...' - усі групи 1.1-6.2 одразу."""
+        heads = list(self.GROUP_RE.finditer(text_block))
+        groups = {}
+        for i, m in enumerate(heads):
+            if not m.group(2) or m.group(1) in groups: continue
+            content = text_block[m.end():heads[i + 1].start() if i + 1 < len(heads) else len(text_block)].strip()
+            if "Електроенергія є." in content and "немає" not in content:
+                groups[m.group(1)] = {"is_full_light": True, "periods": [], "mask": 0}
+                continue
+            periods, mask = [], 0
+            for s, e in self.PERIOD_RE.findall(content):
+                s_min, e_min = to_minutes(s), to_minutes(e)
+                periods.append((s, e, s_min, e_min))
+                mask |= span_mask(s_min, e_min)
+            groups[m.group(1)] = {"is_full_light": False, "periods": periods, "mask": mask}
+        return groups
 
+    def analyze(self, snap):
+        """Розбір один раз для всіх підписників."""
+        full_text = snap["text"]
+        current_dates = self.DATE_RE.findall(full_text)
+        found_times = self.TIME_RE.findall(full_text)
+        blocks = full_text.split(self.BLOCK_HEAD)[1:]
         now_obj = datetime.now()
-        footer_date = now_obj.strftime("%Y.%m.%d")
         today = now_obj.date()
-        site_valid = any(datetime.strptime(d, "%d.%m.%Y").date() >= today for d in current_dates)
-        stored_valid = any(datetime.strptime(d, "%d.%m.%Y").date() >= today for d in last_dates)
-
-        # ПЕРЕВІРКА АКТУАЛЬНОСТІ ТА ЗАГЛУШКА
-        if not site_valid:
-            print("📭 [Результат] Актуальних графіків на сайті немає.")
-            no_graph_msg = f"●▬▬▬▬▬▬ஜ۩۞۩ஜ▬▬▬▬▬▬●\n‎░░  <b>Графіків відключень не має.</b> ░░\n●▬▬▬▬▬▬ஜ۩۞۩ஜ▬▬▬▬▬▬●\n                        {footer_date}"
-            
-            # Якщо користувач написав повідомлення — ЗАВЖДИ повна зачистка
-            if user_interfered:
-                print("📢 [Дія] Запит користувача: повне очищення та нова заглушка.")
-                clear_chat_5(msg_ids)
-                r = requests.post(f"https://api.telegram.org{TOKEN}/sendMessage", data={'chat_id': CHAT_ID, 'text': no_graph_msg, 'parse_mode': 'HTML'}).json()
-                new_mid = r.get('result', {}).get('message_id')
-                save_memory(current_group, current_variant, [new_mid] if new_mid else [], [], {}, [])
-            # Якщо заглушка вже є, а дані старі — оновлюємо дату в ній
-            elif msg_ids and not stored_valid:
-                print("📝 [Дія] Оновлення дати у існуючій заглушці.")
-                requests.post(f"https://api.telegram.org{TOKEN}/editMessageText", data={'chat_id': CHAT_ID, 'message_id': msg_ids[0] if isinstance(msg_ids, list) else msg_ids, 'text': no_graph_msg, 'parse_mode': 'HTML'})
-                save_memory(current_group, current_variant, msg_ids, [], {}, [])
-            # В інших випадках (перший запуск тощо) — шлемо нову
-            elif (not stored_valid and last_dates) or not msg_ids:
-                print("📢 [Дія] Вивід рамки-заглушки.")
-                clear_chat_5(msg_ids)
-                r = requests.post(f"https://api.telegram.org{TOKEN}/sendMessage", data={'chat_id': CHAT_ID, 'text': no_graph_msg, 'parse_mode': 'HTML'}).json()
-                new_mid = r.get('result', {}).get('message_id')
-                save_memory(current_group, current_variant, [new_mid] if new_mid else [], [], {}, [])
-            return
+        return {
+            "provider": self.name, "site": self.site,
+            "dates": current_dates, "times": found_times, "imgs": snap["imgs"],
+            "parsed": [self.parse_block(b) for b in blocks[:len(current_dates)]],
+            "valid": any(datetime.strptime(d, "%d.%m.%Y").date() >= today for d in current_dates),
+            "footer_date": now_obj.strftime("%Y.%m.%d"),
+            "day": now_obj.strftime("%d.%m.%Y"),
+        }
+
+PROVIDER_CLASSES = {"loe": LoeProvider}
+LOE_PARSER = LoeProvider()  # спільний екземпляр для extract_group_info - без нового адаптера на кожен виклик
+
+class ProviderRunner:
+    """Паралельне завантаження всіх провайдерів: у кожного своя FetchSession і свій дедлайн,
+    тож повільний чи зламаний сайт не тримає інших, а цикл триває як найповільніший провайдер.
+    Кожна спроба - у daemon-потоці: завислий сайт не затримує ні вихід процесу, ні зупинку демона."""
+
+    def __init__(self, names=PROVIDERS):
+        self.providers = {}
+        for name in names:
+            if name in PROVIDER_CLASSES: self.providers[name] = PROVIDER_CLASSES[name]()
+            else: print(f"⚠️ [Провайдер] Невідомий провайдер '{name}', пропускаю.")
+        self.sessions = {name: FetchSession() for name in self.providers}
+        self.pending = {}   # провайдер -> Future спроби, що ще не завершилась після таймауту
+        self.failed = set()
+
+    def _fetch(self, name, source):
+        provider = self.providers[name]
+        print(f"🌐 [Крок 2] [{name}] Завантаження графіків {provider.site} ...")
+        with metrics.span(f"provider_{name}"):
+            return provider.fetch(self.sessions[name], source)
+
+    def _start(self, name, source):
+        fut = Future()
+        def run():
+            try: fut.set_result(self._fetch(name, source))
+            except Exception as e: fut.set_exception(e)
+        threading.Thread(target=run, name=f"provider-{name}", daemon=True).start()
+        return fut
+
+    def fetch_all(self, sources):
+        """{провайдер: знімок або None}. Той, хто не вклався в таймаут, пропускає цикл; його сесію замінюємо,
+        а нову спробу не запускаємо, доки зависла не завершиться."""
+        started, snaps, self.failed = time.time(), {}, set()
+        futures = {}
+        for name in self.providers:
+            if name in self.pending and not self.pending[name].done():
+                print(f"⏱ [Провайдер] '{name}' досі не відповів на попередню спробу, пропускаю цей цикл.")
+                continue
+            self.pending.pop(name, None)
+            futures[name] = self._start(name, sources.get(name))
+        for name in self.providers:
+            fut = futures.get(name)
+            snaps[name] = None
+            timeout = self.providers[name].timeout
+            try:
+                if fut: snaps[name] = fut.result(timeout=max(0.0, started + timeout - time.time()))
+            except FutureTimeout:
+                print(f"⏱ [Провайдер] '{name}' не вклався у {timeout} с, пропускаю цей цикл.")
+                metrics.inc("bot_provider_timeouts_total", provider=name)
+                stale, self.sessions[name] = self.sessions[name], FetchSession()
+                fut.add_done_callback(lambda _, s=stale: s.close()) # закриваємо, щойно зависла спроба завершиться
+                self.pending[name] = fut
+            except Exception as e:
+                print(f"⚠️ [Провайдер] '{name}' впав: {e}")
+            if snaps[name] is None: self.failed.add(name)
+        return snaps
+
+    def end_cycle(self):
+        for name, session in self.sessions.items(): session.end_cycle(failed=name in self.failed)
 
-        new_hours_data_map = {}
-        for i, b in enumerate(blocks):
-            if i >= len(current_dates): break
-            date_str, site_time = current_dates[i], found_times[i] if i < len(found_times) else "00:00"
-            txt, dat = extract_group_info(b, current_group, hours_by_date.get(date_str))
-            dat["site_time"], dat["full_text_msg"] = site_time, txt
-            new_hours_data_map[date_str] = dat
+    def close(self):
+        for session in self.sessions.values(): session.close()
+
+# --- КОМАНДИ КОРИСТУВАЧІВ ---
+def apply_command(chat_id, sub, m_text, providers=()):
+    """Зміна налаштувань тільки за суворими командами з "/". providers - провайдери, які зараз опитуються."""
+    if m_text == "/1":
+        sub["variant"] = 1
+        print(f"🔄 [Зміна] [{chat_id}] Обрано ВАРІАНТ 1 (Фото).")
+    elif m_text == "/2":
+        sub["variant"] = 2
+        print(f"🔄 [Зміна] [{chat_id}] Обрано ВАРІАНТ 2 (Текст).")
+    elif m_text == "/remind":
+        sub["reminders"] = not sub.get("reminders", True)
+        print(f"⏰ [Зміна] [{chat_id}] Нагадування {'увімкнено' if sub['reminders'] else 'вимкнено'}.")
+    p_match = re.search(r"^/provider (\w+)$", m_text)
+    if p_match and p_match.group(1) in providers:
+        sub["provider"] = p_match.group(1)
+        sub["hours_by_date"], sub["last_dates"] = {}, []
+        print(f"🏢 [Зміна] [{chat_id}] Обрано ПРОВАЙДЕРА {sub['provider']}. Пам'ять скинуто.")
+    elif p_match: print(f"⚠️ [Зміна] [{chat_id}] Провайдер '{p_match.group(1)}' не опитується (PROVIDERS), лишаю {sub['provider']}.")
+    g_match = re.search(r"^/(\d\.\d)$", m_text)
+    if g_match:
+        sub["group"] = g_match.group(1)
+        sub["hours_by_date"], sub["last_dates"] = {}, []
+        print(f"🎯 [Зміна] [{chat_id}] Обрано ГРУПУ {sub['group']}. Пам'ять скинуто.")
+
+def collect_user_commands(mem, updates=None, providers=()):
+    """Крок 1: нові повідомлення з усіх чатів. Повертає {chat_id: [тексти]} чатів, де писав користувач
+    (порожній список - новий чат, якому ще треба надіслати графік, але без зачистки).
+    updates=None - забрати їх самостійно одним getUpdates від збереженого offset (разовий запуск);
+    інакше - обробити те, що вже отримав CommandListener."""
+    subscribers = mem["subscribers"]
+    interfered = {}
+    if updates is None:
+        resp = tg.call("getUpdates", {'limit': 100, 'offset': mem.get("update_offset", 0), 'timeout': 0})
+        updates = resp.get('result') or []
+    for upd in updates:
+        # Підтвердження - через offset наступного запиту, окремий виклик не потрібен
+        mem["update_offset"] = max(mem.get("update_offset", 0), upd['update_id'] + 1)
+        msg_obj = upd.get('message', {})
+        chat_id = str(msg_obj.get('chat', {}).get('id', ''))
+        m_text = msg_obj.get('text', '').strip()
+        m_id = msg_obj.get('message_id', 0)
+        if not chat_id: continue
+        if chat_id not in subscribers:
+            # Новий чат підписується будь-якою командою ("/start", "/3.2" тощо)
+            if not m_text.startswith("/"): continue
+            subscribers[chat_id] = new_subscriber()
+            interfered.setdefault(chat_id, []) # інакше відбиток сторінки пропустить розсилку новому чату
+            print(f"👋 [Підписка] Новий чат {chat_id}.")
+        sub = subscribers[chat_id]
+        if m_text == "/stats":
+            # Довідка без перебудови чату; обидва повідомлення приберуться при наступній зачистці
+            r = tg.call("sendMessage", {'chat_id': chat_id, 'text': stats_report(mem["stats"], group_key(sub["provider"], sub["group"])), 'parse_mode': 'HTML'})
+            sub["user_ids"].extend(i for i in (m_id, tg.message_id(r)) if i and i not in sub["user_ids"])
+            print(f"📊 [Статистика] [{chat_id}] Надіслано звіт для групи {sub['group']}.")
+            continue
+        # Визначаємо останній ID від бота
+        msg_ids = sub["msg_ids"]
+        last_bot_mid = max(msg_ids) if msg_ids and isinstance(msg_ids, list) else (msg_ids if isinstance(msg_ids, int) else 0)
+        # Будь-яка активність після бота активує повну зачистку чату
+        if m_id > last_bot_mid:
+            interfered.setdefault(chat_id, []).append(f"'{m_text}'") # Фіксуємо текст для звіту
+            if m_id not in sub["user_ids"]: sub["user_ids"].append(m_id) # щоб прибрати при зачистці
+            if m_text.startswith("/"): apply_command(chat_id, sub, m_text, providers)
+            else: print(f"🧹 [Дія] [{chat_id}] Помічено звичайний текст: '{m_text}'. Чат буде очищено.")
+    return interfered
+
+class CommandListener(threading.Thread):
+    """Безперервний long-polling getUpdates у фоні; оновлення йдуть у чергу для головного циклу."""
+
+    def __init__(self, offset=0):
+        super().__init__(name="command-listener", daemon=True)
+        self.client = TelegramClient()
+        self.offset = offset
+        self.updates = queue.Queue()
+
+    def run(self):
+        while not STOP.is_set():
+            try:
+                resp = self.client.call("getUpdates", {'offset': self.offset, 'timeout': TG_LONG_POLL, 'allowed_updates': '["message"]'}, timeout=TG_LONG_POLL + 10)
+                for upd in resp.get('result') or []:
+                    self.offset = max(self.offset, upd['update_id'] + 1)
+                    self.updates.put(upd)
+                if not resp.get('ok', True): STOP.wait(5)
+            except Exception as e:
+                print(f"⚠️ [Слухач] {e}")
+                STOP.wait(5)
+
+    def wait_updates(self, timeout):
+        """Чекає до timeout секунд на перше оновлення, потім забирає все, що накопичилось."""
+        deadline = time.time() + timeout
+        while not STOP.is_set():
+            try:
+                batch = [self.updates.get(timeout=max(0.0, min(1.0, deadline - time.time())))]
+                break
+            except queue.Empty:
+                if time.time() >= deadline: return []
+        else: return []
+        time.sleep(1) # коротке вікно, щоб зібрати серію команд однією обробкою
+        return batch + self.drain()
 
-        any_schedule_change = any(d not in hours_by_date or new_hours_data_map[d]["periods"] != hours_by_date[d]["periods"] for d in current_dates)
-        any_site_time_change = any(d in hours_by_date and new_hours_data_map[d]["site_time"] != hours_by_date[d].get("site_time") for d in current_dates)
-        new_graph_appeared = any(d not in last_dates for d in current_dates)
+    def drain(self):
+        """Усе, що вже лежить у черзі, без очікування."""
+        batch = []
+        while True:
+            try: batch.append(self.updates.get_nowait())
+            except queue.Empty: return batch
 
-        should_update = user_interfered or any_schedule_change or new_graph_appeared
-        if current_variant == 1 and any_site_time_change: should_update = True
+# --- ОНОВЛЕННЯ ОДНОГО ПІДПИСНИКА ---
+def update_subscriber(chat_id, sub, page, user_commands_log):
+    """Приводить чат підписника у відповідність до сторінки. Повертає гілку: rebuild/edit/prune/stub/noop,
+    або fail, якщо Telegram не прийняв хоч одне надсилання/редагування (тоді відбиток сторінки не зберігається)."""
+    current_group, current_variant = sub["group"], sub["variant"]
+    msg_ids, last_imgs = sub["msg_ids"], sub["last_imgs"]
+    hours_by_date, last_dates = sub["hours_by_date"], sub["last_dates"]
+    current_dates, found_times, current_imgs = page["dates"], page["times"], page["imgs"]
+    user_interfered = bool(user_commands_log)
+    today = datetime.now().date()
+    stored_valid = any(datetime.strptime(d, "%d.%m.%Y").date() >= today for d in last_dates)
 
-        #if should_update:
-            #print("🚀 [Дія] Помічено зміни або запит! Виконуємо повне оновлення з очищенням.")
+    # ПЕРЕВІРКА АКТУАЛЬНОСТІ ТА ЗАГЛУШКА
+    if not page["valid"]:
+        no_graph_msg = f"●▬▬▬▬▬▬ஜ۩۞۩ஜ▬▬▬▬▬▬●\n‎░░  <b>Графіків відключень не має.</b> ░░\n●▬▬▬▬▬▬ஜ۩۞۩ஜ▬▬▬▬▬▬●\n                        {page['footer_date']}"
 
+        # Якщо користувач написав повідомлення — ЗАВЖДИ повна зачистка
+        if user_interfered:
+            print(f"📢 [Дія] [{chat_id}] Запит користувача: повне очищення та нова заглушка.")
+            clear_chat_5(sub, chat_id)
+            r = tg.call("sendMessage", {'chat_id': chat_id, 'text': no_graph_msg, 'parse_mode': 'HTML'})
+            new_mid = tg.message_id(r)
+            set_state(sub, [new_mid] if new_mid else [], [], {}, [])
+            if not new_mid: return "fail"
+        # Заглушка вже показує сьогоднішню дату - правити нічого
+        elif msg_ids and not last_dates and sub.get("stub_date") == page["footer_date"]: return "noop"
+        # Якщо заглушка вже є, а дані старі — оновлюємо дату в ній
+        elif msg_ids and not stored_valid:
+            print(f"📝 [Дія] [{chat_id}] Оновлення дати у існуючій заглушці.")
+            r = tg.call("editMessageText", {'chat_id': chat_id, 'message_id': msg_ids[0] if isinstance(msg_ids, list) else msg_ids, 'text': no_graph_msg, 'parse_mode': 'HTML'})
+            if not tg.ok(r): return "fail" # стан не чіпаємо - наступний цикл спробує ще раз
+            set_state(sub, msg_ids, [], {}, [])
+        # В інших випадках (перший запуск тощо) — шлемо нову
+        elif (not stored_valid and last_dates) or not msg_ids:
+            print(f"📢 [Дія] [{chat_id}] Вивід рамки-заглушки.")
+            clear_chat_5(sub, chat_id)
+            r = tg.call("sendMessage", {'chat_id': chat_id, 'text': no_graph_msg, 'parse_mode': 'HTML'})
+            new_mid = tg.message_id(r)
+            set_state(sub, [new_mid] if new_mid else [], [], {}, [])
+            if not new_mid: return "fail"
+        else: return "noop"
+        sub["stub_date"] = page["footer_date"]
+        return "stub"
 
+    new_hours_data_map = {}
+    for i, groups in enumerate(page["parsed"]):
+        date_str, site_time = current_dates[i], found_times[i] if i < len(found_times) else "00:00"
+        txt, dat = render_group_info(groups.get(current_group), hours_by_date.get(date_str))
+        dat["site_time"], dat["full_text_msg"] = site_time, txt
+        new_hours_data_map[date_str] = dat
 
+    # Фото: власний рендер графіка групи на кожну дату; текстовий режим посилається на PNG сайту
+    if current_variant == 1 and IMAGE_SOURCE == "local":
+        current_imgs = [render_ref(current_group, d, groups.get(current_group)) for d, groups in zip(current_dates, page["parsed"])]
 
+    def caption(date_str):
+        data = new_hours_data_map[date_str]
+        return f"📅 {date_str} група {current_group}\n⏱ <i>Станом на {data['site_time']}</i>\n{data['full_text_msg']}"
 
-        # --- ВИЗНАЧЕННЯ ПРИЧИН ---
+    def send(i):
+        url, cap = img_url(current_imgs[i], page["site"]), caption(current_dates[i])
+        if current_variant == 1: r = image_cache.send_photo(chat_id, url, cap)
+        else: r = tg.call("sendMessage", {'chat_id': chat_id, 'text': f'<b><a href="{url}">---- Графік відключень.</a></b>\n{cap}', 'parse_mode': 'HTML', 'disable_web_page_preview': False})
+        return tg.message_id(r)
+
+    def edit(i, mid, old_img):
+        url, cap = img_url(current_imgs[i], page["site"]), caption(current_dates[i])
+        if current_variant != 1:
+            r = tg.call("editMessageText", {'chat_id': chat_id, 'message_id': mid, 'text': f'<b><a href="{url}">---- Графік відключень.</a></b>\n{cap}', 'parse_mode': 'HTML'})
+        elif old_img and img_url(old_img, page["site"]) == url:
+            r = tg.call("editMessageCaption", {'chat_id': chat_id, 'message_id': mid, 'caption': cap, 'parse_mode': 'HTML'})
+        else: r = image_cache.send_photo(chat_id, url, cap, message_id=mid) # нова картинка + підпис одним викликом
+        return tg.ok(r)
+
+    # Запит користувача - завжди повне оновлення; інакше - мінімальний набір правок, якщо він можливий
+    ops = None if user_interfered else plan_changes(sub, current_dates, new_hours_data_map, current_imgs)
+
+    if ops is None:
         update_reasons = []
-        if user_interfered: 
+        if user_interfered:
             update_reasons.append(f"Запит користувача: [{', '.join(user_commands_log)}]")
-        if any_schedule_change: 
+        if any(d not in hours_by_date or new_hours_data_map[d]["periods"] != hours_by_date[d]["periods"] for d in current_dates):
             update_reasons.append("Зміна в годинах відключень")
-        if current_variant == 1 and any_site_time_change: 
-            update_reasons.append("Оновлення часу 'станом на' (режим Фото)")
-        
-        # Якщо є хоча б одна з критичних причин — ПОВНЕ ОНОВЛЕННЯ
-        if user_interfered or any_schedule_change:
-            print(f"🚀 [Дія] ПОВНЕ ОНОВЛЕННЯ. Причини: {'; '.join(update_reasons)}.")
-            clear_chat_5(msg_ids)
-            new_mids = []
-            for i, date_str in enumerate(current_dates):
-                if i >= len(current_imgs): break
-                data = new_hours_data_map[date_str]
-                cap = f"📅 {date_str} група {current_group}\n⏱ <i>Станом на {data['site_time']}</i>\n{data['full_text_msg']}"
-                
-                if current_variant == 1:
-                    img_data = requests.get(urljoin(URL_SITE, current_imgs[i])).content
-                    r = requests.post(f"https://api.telegram.org{TOKEN}/sendPhoto", data={'chat_id': CHAT_ID, 'caption': cap, 'parse_mode': 'HTML'}, files={'photo': ('g.png', io.BytesIO(img_data))}).json()
-                else:
-                    link = f'<b><a href="{urljoin(URL_SITE, current_imgs[i])}">---- Графік відключень.</a></b>'
-                    r = requests.post(f"https://api.telegram.org{TOKEN}/sendMessage", data={'chat_id': CHAT_ID, 'text': f"{link}\n{cap}", 'parse_mode': 'HTML', 'disable_web_page_preview': False}).json()
-                
-                mid = r.get('result', {}).get('message_id')
-                if mid: new_mids.append(mid)
-            save_memory(current_group, current_variant, new_mids, current_imgs, new_hours_data_map, current_dates)
-            print("✅ [Результат] Чат перестворено наново.")
-
-        # Якщо критичних причин немає, але з'явився новий день або змінився час "станом на"
-        elif new_graph_appeared or any_site_time_change:
-            print(f"📝 [Дія] ТОЧКОВЕ ОНОВЛЕННЯ. Причини: {'Нова дата' if new_graph_appeared else 'Оновлення часу'}.")
-            current_mids = list(msg_ids) if isinstance(msg_ids, list) else ([msg_ids] if msg_ids else [])
-            
-            for i, date_str in enumerate(current_dates):
-                if i >= len(current_imgs): break
-                data = new_hours_data_map[date_str]
-                cap = f"📅 {date_str} група {current_group}\n⏱ <i>Станом на {data['site_time']}</i>\n{data['full_text_msg']}"
-                
-                # 1. РЕДАГУЄМО існуючі повідомлення (якщо змінився час)
-                if i < len(current_mids):
-                    old_st = hours_by_date.get(date_str, {}).get("site_time")
-                    if data['site_time'] != old_st:
-                        print(f"✏️ [Редагування] Оновлено час для {date_str}")
-                        if current_variant == 1:
-                            requests.post(f"https://api.telegram.org{TOKEN}/editMessageCaption", data={'chat_id': CHAT_ID, 'message_id': current_mids[i], 'caption': cap, 'parse_mode': 'HTML'})
-                        else:
-                            link = f'<b><a href="{urljoin(URL_SITE, current_imgs[i])}">---- Графік відключень.</a></b>'
-                            requests.post(f"https://api.telegram.org{TOKEN}/editMessageText", data={'chat_id': CHAT_ID, 'message_id': current_mids[i], 'text': f"{link}\n{cap}", 'parse_mode': 'HTML'})
-                
-                # 2. ДОСИЛАЄМО нові повідомлення (якщо з'явився 2-й графік)
-                else:
-                    print(f"➕ [Досилання] Новий графік: {date_str}")
-                    if current_variant == 1:
-                        img_data = requests.get(urljoin(URL_SITE, current_imgs[i])).content
-                        r = requests.post(f"https://api.telegram.org{TOKEN}/sendPhoto", data={'chat_id': CHAT_ID, 'caption': cap, 'parse_mode': 'HTML'}, files={'photo': ('g.png', io.BytesIO(img_data))}).json()
-                    else:
-                        link = f'<b><a href="{urljoin(URL_SITE, current_imgs[i])}">---- Графік відключень.</a></b>'
-                        r = requests.post(f"https://api.telegram.org{TOKEN}/sendMessage", data={'chat_id': CHAT_ID, 'text': f"{link}\n{cap}", 'parse_mode': 'HTML'}).json()
-                    
-                    mid = r.get('result', {}).get('message_id')
-                    if mid: current_mids.append(mid)
-            
-            save_memory(current_group, current_variant, current_mids, current_imgs, new_hours_data_map, current_dates)
-            print("✅ [Результат] Чат актуалізовано (редаговано/дослано).")
+        if not update_reasons: update_reasons.append("Порядок повідомлень не зберегти правками")
+        print(f"🚀 [Дія] [{chat_id}] ПОВНЕ ОНОВЛЕННЯ. Причини: {'; '.join(update_reasons)}.")
+        clear_chat_5(sub, chat_id)
+        sent = [send(i) for i in range(min(len(current_dates), len(current_imgs)))]
+        # Неповний набір (msg_ids коротший за last_dates) наступного циклу знову дасть повну перебудову
+        set_state(sub, [mid for mid in sent if mid], current_imgs, new_hours_data_map, current_dates)
+        if not all(sent):
+            print(f"⚠️ [Результат] [{chat_id}] Telegram не прийняв {sent.count(None)} з {len(sent)} повідомлень.")
+            return "fail"
+        print(f"✅ [Результат] [{chat_id}] Чат перестворено наново.")
+        return "rebuild"
+
+    if not ops: return "noop"
+
+    drops = [op[1] for op in ops if op[0] == "drop"]
+    edits = [op for op in ops if op[0] == "edit"]
+    appends = [op[1] for op in ops if op[0] == "append"]
+    print(f"📝 [Дія] [{chat_id}] ТОЧКОВЕ ОНОВЛЕННЯ: редагувань {len(edits)}, нових дат {len(appends)}, видалень {len(drops)}.")
+    if drops: tg.delete_messages(chat_id, drops)
+    old_imgs = dict(zip(last_dates, last_imgs))
+    mids_by_date = {d: mid for d, mid in zip(last_dates, msg_ids) if d in current_dates}
+    failed = 0
+    for _, i, mid in edits:
+        print(f"✏️ [Редагування] {current_dates[i]}")
+        if not edit(i, mid, old_imgs.get(current_dates[i])):
+            # Дату забуваємо: наступний цикл дошле її заново, а старе повідомлення прибере зачистка
+            failed += 1
+            del mids_by_date[current_dates[i]]
+            tg.delete_messages(chat_id, [mid])
+            if mid not in sub["user_ids"]: sub["user_ids"].append(mid)
+    for i in appends:
+        print(f"➕ [Досилання] Новий графік: {current_dates[i]}")
+        mid = send(i)
+        if mid: mids_by_date[current_dates[i]] = mid
+        else: failed += 1
+    kept = [d for d in current_dates if d in mids_by_date]
+    kept_imgs = [current_imgs[j] if j < len(current_imgs) else None for j, d in enumerate(current_dates) if d in mids_by_date]
+    set_state(sub, [mids_by_date[d] for d in kept], kept_imgs, new_hours_data_map, kept)
+    if failed:
+        print(f"⚠️ [Результат] [{chat_id}] Telegram не прийняв {failed} правок/повідомлень, повтор у наступному циклі.")
+        return "fail"
+    print(f"✅ [Результат] [{chat_id}] Чат актуалізовано (редаговано/дослано/видалено).")
+    return "edit" if edits or appends else "prune"
+
+def dispatch_updates(subscribers, page, interfered):
+    """Розсилка по підписниках через обмежений пул потоків; кожен потік змінює лише свого підписника."""
+    def run(item):
+        chat_id, sub = item
+        try: return update_subscriber(chat_id, sub, page, interfered.get(chat_id, []))
+        except Exception as e:
+            print(f"❌ [Помилка] [{chat_id}] {e}")
+            return "fail"
+    with ThreadPoolExecutor(max_workers=max(1, min(SEND_WORKERS, len(subscribers)))) as pool:
+        return dict(zip(subscribers, pool.map(run, list(subscribers.items()))))
+
+# --- ГОЛОВНА ЛОГІКА ---
+BRANCH_PRIORITY = ["rebuild", "edit", "stub", "prune", "fail", "noop"]
+
+_last_pages = {} # остання розібрана сторінка кожного провайдера: команди в режимі демона - без повторного скрапінгу
+
+def check_and_update(runner=None, updates=None, scrape=True, full=False):
+    """Один цикл перевірки. Повертає найвагомішу гілку серед підписників: rebuild/edit/prune/stub/noop/fail.
+    updates - оновлення від CommandListener (None - опитати Telegram самостійно);
+    scrape=False - використати вже розібрану сьогодні сторінку, якщо вона є;
+    full=True - не зважати на збережений відбиток і розібрати сторінку (перший цикл демона будує таймлайн)."""
+    metrics.begin_cycle()
+    branch = "fail"
+    try:
+        branch = _run_cycle(runner, updates, scrape, full)
+        return branch
+    finally:
+        metrics.end_cycle(branch)
+
+def _run_cycle(runner, updates, scrape, full=False):
+    print(f"🕒 [{datetime.now().strftime('%H:%M:%S')}] --- ЗАПУСК ПЕРЕВІРКИ ---")
+    with metrics.span("load_memory"):
+        mem = load_memory()
+
+    own_runner = runner is None
+    if own_runner: runner = ProviderRunner()
+    print("📩 [Крок 1] Перевірка повідомлень...")
+    interfered = {}
+    try:
+        with metrics.span("commands"):
+            interfered = collect_user_commands(mem, updates, runner.providers)
+    except Exception as e:
+        print(f"⚠️ [Крок 1] Помилка: {e}")
+
+    try:
+        # Відбиток дійсний лише в межах доби: з новою датою змінюється актуальність графіків
+        day = datetime.now().strftime("%d.%m.%Y")
+        by_provider = defaultdict(dict)
+        for chat_id, sub in mem["subscribers"].items(): by_provider[sub["provider"]][chat_id] = sub
+        snaps = {}
+        if not scrape and all(_last_pages.get(n, {}).get("day") == day for n in runner.providers):
+            print("⚡ [Крок 2] Застосовуємо команди до вже завантажених сторінок, без скрапінгу.")
+            pages = {n: _last_pages[n] for n in runner.providers}
+        else:
+            sources = {}
+            for name in runner.providers:
+                source = mem["sources"].get(name, {})
+                touched = any(chat_id in interfered for chat_id in by_provider[name])
+                sources[name] = source if source.get("day") == day and not touched and not full else None
+
+            with metrics.span("fetch"):
+                snaps = runner.fetch_all(sources)
+            if not any(snaps.values()):
+                print("🛑 [Стоп] Жоден провайдер не зміг завантажити сторінку.")
+                return "fail" # Вихід із функції (цикл зупиниться)
+            pages = {}
+            for name, snap in snaps.items():
+                source = sources[name]
+                if not snap: continue
+                if source and (snap["status"] == "unchanged" or snap["fingerprint"] == source.get("hash")):
+                    print(f"✅ [Статус] [{name}] Джерело не змінилось (відбиток збігся). Дій не потрібно.")
+                    continue
+                with metrics.span("parse"):
+                    page = pages[name] = _last_pages[name] = runner.providers[name].analyze(snap)
+                    fresh = record_history(mem["history"], page)
+                    for group, date_str, mask, _ in fresh: update_stats(mem["stats"], group, date_str, mask)
+                    append_history_log(fresh)
+                    timeline.sync(page)
+                print(f"📊 [Аналіз] [{name}] На сайті знайдено графіків: {len(page['dates'])}.")
+                if not page["valid"]: print(f"📭 [Результат] [{name}] Актуальних графіків на сайті немає.")
+            if not pages: return "fail" if runner.failed else "noop"
+
+        image_cache.attach(mem.setdefault("images", {}))
+        branches = {}
+        with metrics.span("dispatch"):
+            for name, page in pages.items():
+                result = dispatch_updates(by_provider[name], page, interfered) if by_provider[name] else {}
+                branches.update(result)
+                snap = snaps.get(name)
+                if snap and "fail" not in result.values():
+                    # Запам'ятовуємо відбиток лише коли всі підписники провайдера отримали цю версію
+                    mem["sources"][name] = {"hash": snap["fingerprint"], "etag": snap.get("etag"), "modified": snap.get("modified"), "day": day}
+        for b in branches.values(): metrics.inc("bot_subscriber_updates_total", branch=b)
+        if all(b == "noop" for b in branches.values()): print("✅ [Статус] Дані ідентичні. Дій не потрібно.")
+        return min(branches.values(), key=BRANCH_PRIORITY.index, default="noop")
+
+    except Exception as e:
+        print(f"❌ [Помилка] {e}")
+        return "fail"
+    finally:
+        with metrics.span("save_memory"):
+            saved = save_memory(mem)
+        if not saved: print("💾 [Пам'ять] Стан не змінився, файл не переписуємо.")
+        if own_runner: runner.close()
+
+# --- НАГАДУВАННЯ (ТАЙМЛАЙН ПЕРЕХОДІВ) ---
+class Timeline:
+    """Купа майбутніх нагадувань про вимкнення/увімкнення. Подія - (група, дата, вид, хвилина, за скільки хв).
+    Зміна графіка групи на дату лише додає нові події та скасовує зниклі: скасовані лишаються в купі
+    і відкидаються при витягуванні, купа не перебудовується.
+    Відключення через північ - одне: "off" о 00:00 не шлеться, якщо попередня доба закінчується без світла,
+    а "on" о 24:00 - лише коли відомо, що наступна доба починається зі світлом."""
+
+    def __init__(self, leads=REMINDER_LEADS):
+        self.leads = leads
+        self.heap = []                 # (час спрацювання, seq, ключ)
+        self.live = {}                 # ключ -> seq актуального запису в купі
+        self.slots = defaultdict(set)  # (група, дата) -> ключі подій
+        self.masks = {}                # (група, дата) -> маска, з якої побудовано події
+        self.seq = 0
+
+    def sync(self, page, now=None):
+        """Оновлює події з розібраної сторінки; перераховуються лише групи/дати зі зміненою маскою.
+        Групи/дати цього провайдера, яких на сторінці вже немає (графік відкликано), скасовуються."""
+        now = now or time.time()
+        seen = set()
+        for i, groups in enumerate(page["parsed"]):
+            date_str = page["dates"][i]
+            for group, info in groups.items():
+                group = group_key(page["provider"], group)
+                seen.add((group, date_str))
+                if self.masks.get((group, date_str)) != info["mask"]:
+                    self.update(group, date_str, info["mask"], now)
+        for slot in [s for s in self.masks if s not in seen and key_provider(s[0]) == page["provider"]]:
+            self.cancel(slot, now)
+
+    def cancel(self, slot, now=None):
+        for key in self.slots.pop(slot, ()): self.live.pop(key, None)
+        self.masks.pop(slot, None)
+        self.resync_neighbours(slot, now or time.time())
 
-        elif len(msg_ids) > len(current_imgs) and site_valid:
-            print(f"🗑 [Дія] Зайві графіки зникли. Видаляємо.")
-            for _ in range(len(msg_ids) - len(current_imgs)):
-                mid = msg_ids.pop(0)
-                requests.post(f"https://api.telegram.org{TOKEN}/deleteMessage", data={'chat_id': CHAT_ID, 'message_id': mid})
-            save_memory(current_group, current_variant, msg_ids, current_imgs, new_hours_data_map, current_dates)
-        else: 
-            print("✅ [Статус] Дані ідентичні. Дій не потрібно.")
-            save_memory(current_group, current_variant, msg_ids, last_imgs, hours_by_date, last_dates)
+    def neighbour(self, slot, days):
+        return (slot[0], (datetime.strptime(slot[1], "%d.%m.%Y") + timedelta(days=days)).strftime("%d.%m.%Y"))
 
+    def resync_neighbours(self, slot, now):
+        """Події на межі діб залежать від сусідньої доби - перераховуємо відомих сусідів."""
+        for days in (-1, 1):
+            other = self.neighbour(slot, days)
+            if other in self.masks: self.update(*other, self.masks[other], now, resync=False)
 
+    def update(self, group, date_str, mask, now, resync=True):
+        slot = (group, date_str)
+        self.masks[slot] = mask
+        midnight = datetime.strptime(date_str, "%d.%m.%Y").timestamp()
+        prev_mask, next_mask = self.masks.get(self.neighbour(slot, -1), 0), self.masks.get(self.neighbour(slot, 1))
+        off_at_midnight = not (prev_mask >> (DAY_MINUTES - 1)) & 1 # інакше відключення триває з учора
+        on_at_midnight = next_mask is not None and not next_mask & 1  # невідома наступна доба - мовчимо
+        new_keys = set()
+        for start, end in mask_runs(mask):
+            for lead in self.leads:
+                if start > 0 or off_at_midnight: new_keys.add((group, date_str, "off", start, lead))
+                if end < DAY_MINUTES or on_at_midnight: new_keys.add((group, date_str, "on", end, lead))
+        old_keys = self.slots[slot]
+        for key in old_keys - new_keys: self.live.pop(key, None) # скасування
+        for key in new_keys - old_keys:
+            fire_at = midnight + (key[3] - key[4]) * 60
+            if fire_at <= now: continue
+            self.seq += 1
+            self.live[key] = self.seq
+            heapq.heappush(self.heap, (fire_at, self.seq, key))
+        self.slots[slot] = {k for k in new_keys if k in self.live}
+        if resync: self.resync_neighbours(slot, now)
 
+    def _drop_cancelled(self):
+        while self.heap and self.live.get(self.heap[0][2]) != self.heap[0][1]:
+            heapq.heappop(self.heap)
 
+    def next_due(self):
+        self._drop_cancelled()
+        return self.heap[0][0] if self.heap else None
 
+    def pop_due(self, now=None):
+        now = now or time.time()
+        due = []
+        self._drop_cancelled()
+        while self.heap and self.heap[0][0] <= now:
+            fire_at, _, key = heapq.heappop(self.heap)
+            del self.live[key]
+            self.slots[(key[0], key[1])].discard(key)
+            if now - fire_at <= REMINDER_MAX_LATE: due.append(key)
+            self._drop_cancelled()
+        return due
 
-    except Exception as e: print(f"❌ [Помилка] {e}")
+timeline = Timeline()
+
+def reminder_text(key):
+    group, date_str, kind, minute, lead = key
+    group = group.split(":")[-1]
+    at = f"{minute // 60:02d}:{minute % 60:02d}"
+    if kind == "off": return f"⏰ <b>Через {lead} хв ({at}) планове вимкнення світла.</b>\n📅 {date_str} група {group}"
+    return f"💡 <b>Через {lead} хв ({at}) очікується увімкнення світла.</b>\n📅 {date_str} група {group}"
+
+def send_reminders(keys):
+    """Розсилає нагадування підписникам відповідних груп; попереднє нагадування в чаті видаляється."""
+    mem = load_memory()
+    jobs = [(chat_id, sub, key) for key in keys for chat_id, sub in mem["subscribers"].items()
+            if group_key(sub["provider"], sub["group"]) == key[0] and sub.get("reminders", True)]
+    def run(job):
+        chat_id, sub, key = job
+        try:
+            if sub.get("reminder_id"): tg.delete_messages(chat_id, [sub["reminder_id"]])
+            sub["reminder_id"] = tg.message_id(tg.call("sendMessage", {'chat_id': chat_id, 'text': reminder_text(key), 'parse_mode': 'HTML'}))
+            metrics.inc("bot_reminders_total", kind=key[2])
+        except Exception as e: print(f"⚠️ [Нагадування] [{chat_id}] {e}")
+    print(f"⏰ [Нагадування] Подій: {len(keys)}, повідомлень: {len(jobs)}.")
+    if jobs:
+        with ThreadPoolExecutor(max_workers=max(1, min(SEND_WORKERS, len(jobs)))) as pool:
+            list(pool.map(run, jobs))
+    save_memory(mem)
+
+# --- РЕЖИМ ДЕМОНА ---
+class AdaptiveScheduler:
+    """Часте опитування після змін і в години публікацій, експоненційний відкат у тишу."""
+
+    def __init__(self):
+        self.last_change = 0.0
+        self.idle_cycles = 0
+        self.hot_hours = set()
+        for part in PUBLISH_HOURS.split(","):
+            if "-" in part:
+                a, b = part.split("-")
+                self.hot_hours.update(range(int(a), int(b) + 1))
+            elif part.strip():
+                self.hot_hours.add(int(part))
+
+    def next_delay(self, branch, now=None):
+        now = now or time.time()
+        if branch not in ("noop", "fail"):
+            self.last_change, self.idle_cycles = now, 0
+        if now - self.last_change < HOT_WINDOW or datetime.fromtimestamp(now).hour in self.hot_hours:
+            return POLL_FAST
+        delay = min(POLL_MAX, POLL_BASE * 2 ** self.idle_cycles)
+        self.idle_cycles += 1
+        return delay
+
+STOP = threading.Event()
+
+def _on_stop_signal(signum, frame):
+    print(f"🛑 [Сигнал] Отримано {signal.Signals(signum).name}, завершую після поточного циклу...")
+    STOP.set()
+
+def run_daemon():
+    signal.signal(signal.SIGTERM, _on_stop_signal)
+    signal.signal(signal.SIGINT, _on_stop_signal)
+    runner, scheduler = ProviderRunner(), AdaptiveScheduler()
+    start_metrics_server()
+    listener = CommandListener(load_memory().get("update_offset", 0))
+    listener.start()
+    cycle, next_check = 0, 0.0
+    try:
+        while not STOP.is_set():
+            due = timeline.pop_due()
+            if due:
+                send_reminders(due)
+                continue
+            # Команди користувачів обробляються одразу, не чекаючи наступної перевірки сайту
+            wake = min(next_check, timeline.next_due() or next_check)
+            updates = listener.wait_updates(max(0.0, wake - time.time()))
+            if updates:
+                print(f"\n--- КОМАНДИ ({len(updates)}) ---")
+                check_and_update(runner, updates=updates, scrape=False)
+                continue
+            if STOP.is_set(): break
+            if time.time() < next_check: continue # прокинулись заради нагадування
+            cycle += 1
+            print(f"\n--- ЦИКЛ {cycle} (демон) ---")
+            # Таймлайн нагадувань живе лише в процесі: після старту сторінку треба розібрати, навіть якщо вона та сама
+            branch = check_and_update(runner, updates=[], full=cycle == 1)
+            runner.end_cycle()
+            delay = scheduler.next_delay(branch)
+            next_check = time.time() + delay
+            print(f"⏳ [Очікування] {delay} секунд до наступної перевірки (гілка: {branch}).")
     finally:
-        if driver: driver.quit(); print("🔌 [Браузер] Сесію завершено.")
+        # Наступний getUpdates слухача вже підтвердив Telegram усе з черги - необроблене загубилося б назавжди
+        pending = listener.drain()
+        if pending:
+            print(f"\n--- КОМАНДИ ПЕРЕД ЗУПИНКОЮ ({len(pending)}) ---")
+            check_and_update(runner, updates=pending, scrape=False)
+        runner.close()
+    print("\n🏁 [Кінець] Демон зупинено, стан збережено.")
 
 if __name__ == "__main__":
+    if "--export-stats" in sys.argv:
+        # Готові агрегати у JSON: python script.py --export-stats [файл]
+        args = sys.argv[sys.argv.index("--export-stats") + 1:]
+        text = json.dumps(load_memory()["stats"], ensure_ascii=False, indent=1)
+        if args:
+            with open(args[0], "w", encoding="utf-8") as f: f.write(text)
+            print(f"📤 [Статистика] Збережено у {args[0]}.")
+        else: print(text)
+        sys.exit(0)
     print("🤖 Бот запущено. Починаю роботу...")
+    if "--daemon" in sys.argv or os.getenv("BOT_DAEMON") == "1":
+        run_daemon()
+        sys.exit(0)
     for cycle in range(1):
         print(f"\n--- ЦИКЛ {cycle + 1} З 7 ---")
         check_and_update()